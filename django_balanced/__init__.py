@@ -1,3 +1,3 @@
 __version__ = '0.1.10'
 
-from . import settings
+default_app_config = 'django_balanced.apps.BalancedConfig'
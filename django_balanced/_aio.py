@@ -0,0 +1,89 @@
+"""
+The coroutines of `django_balanced.aio`, kept apart as python 2 cannot
+even compile them.
+"""
+from __future__ import unicode_literals
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from django_balanced import tenants, transport
+from django_balanced.sync import sync_all
+
+
+__all__ = ['run', 'afind', 'asave', 'acredit', 'adebit', 'sync',
+           'gather_bounded']
+
+_lock = threading.Lock()
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    settings.BALANCED['ASYNC_WORKERS'])
+    return _executor
+
+
+def _call(tenant, func, *args, **kwargs):
+    # worker threads keep their connection between operations, like
+    # requests do, unless it is broken or older than CONN_MAX_AGE
+    close_old_connections()
+    try:
+        with tenants.activate(tenant):
+            return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run(func, *args, **kwargs):
+    """
+    Runs the blocking `func` on the Balanced worker pool, as the tenant
+    active where it was awaited.
+    """
+    transport.install()
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_get_executor(), functools.partial(
+        _call, tenants.current(), func, *args, **kwargs))
+
+
+async def afind(instance):
+    return await run(instance.find)
+
+
+async def asave(instance, **kwargs):
+    await run(instance.save, **kwargs)
+    return instance
+
+
+async def acredit(bank_account, amount, description=None, meta=None):
+    return await run(bank_account.credit, amount, description, meta=meta)
+
+
+async def adebit(account, amount, description, card=None):
+    return await run(account.debit, amount, description, card=card)
+
+
+async def sync(models=None, workers=1, chunk_size=None, incremental=False):
+    return await run(sync_all, models, workers, chunk_size, incremental)
+
+
+async def gather_bounded(*aws, limit=None):
+    """
+    `asyncio.gather` running at most `limit` of `aws` at once (defaults to
+    `BALANCED['ASYNC_WORKERS']`).
+    """
+    semaphore = asyncio.Semaphore(limit or settings.BALANCED['ASYNC_WORKERS'])
+
+    async def bounded(aw):
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(*[bounded(aw) for aw in aws])
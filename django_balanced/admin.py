@@ -1,14 +1,24 @@
 from __future__ import unicode_literals
 
-import balanced
 from django import forms
 from django.conf.urls import patterns, url
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import ChangeList, ORDER_VAR
+from django.contrib.admin.widgets import ForeignKeyRawIdWidget
 from django.contrib.auth.models import User
 from django.core import urlresolvers
-from django.shortcuts import render, redirect
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.http import HttpResponseRedirect
+from django.shortcuts import get_object_or_404, render, redirect
+from django.utils.dateparse import parse_datetime
 
-from django_balanced.models import BankAccount, Credit
+from django_balanced import escrow, export
+from django_balanced.models import (
+    BankAccount, Credit, PayoutBatch, PayoutItem,
+)
+from django_balanced.payouts import create_batch, run_batch_in_background
 
 """
 TODO:
@@ -18,9 +28,182 @@ TODO:
 """
 
 
+CURSOR_VAR = 'cursor'
+
+
+def _table_estimate(queryset):
+    # the planner's row estimate, free to read but only as fresh as the
+    # last ANALYZE
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    if connection.vendor == 'postgresql':
+        sql = 'SELECT reltuples FROM pg_class WHERE relname = %s'
+    elif connection.vendor == 'mysql':
+        sql = 'SELECT table_rows FROM information_schema.tables ' \
+              'WHERE table_schema = DATABASE() AND table_name = %s'
+    else:
+        return None
+    cursor = connection.cursor()
+    cursor.execute(sql, [table])
+    row = cursor.fetchone()
+    return int(row[0]) if row and row[0] is not None else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    A paginator that never counts a big table: unfiltered tables of more
+    than `cap` rows report the database's estimate, filtered ones are
+    counted up to `cap` rows.
+    """
+    cap = 10000
+
+    def _get_count(self):
+        if getattr(self, '_estimated_count', None) is None:
+            self._estimated_count = self._estimate()
+        return self._estimated_count
+    count = property(_get_count)
+
+    def _estimate(self):
+        queryset = self.object_list
+        if not hasattr(queryset, 'query'):
+            return len(queryset)
+        if not queryset.query.where:
+            estimate = _table_estimate(queryset)
+            if estimate is not None and estimate > self.cap:
+                return estimate
+        return queryset.order_by()[:self.cap + 1].count()
+
+
+class BalancedChangeList(ChangeList):
+    """
+    Pages through rows newest first with a `created_at` cursor instead of
+    an offset while the list is in its default order, so the last page is
+    as cheap as the first. Sorting by a column falls back to numbered
+    pages.
+    """
+
+    def __init__(self, request, *args, **kwargs):
+        # the cursor is no lookup, keep the changelist from filtering on it
+        self.cursor = request.GET.get(CURSOR_VAR)
+        self.next_cursor = None
+        if self.cursor is not None:
+            request.GET = request.GET.copy()
+            del request.GET[CURSOR_VAR]
+        super(BalancedChangeList, self).__init__(request, *args, **kwargs)
+
+    def get_results(self, request):
+        # django < 1.6 calls it query_set
+        name = 'queryset' if 'queryset' in self.__dict__ else 'query_set'
+        queryset = getattr(self, name)
+        if isinstance(self.list_select_related, (list, tuple)):
+            # django < 1.6 turns the fields into a plain select_related(),
+            # which skips nullable foreign keys
+            queryset = queryset.select_related(*self.list_select_related)
+            setattr(self, name, queryset)
+        self.keyset = (self.model_admin.keyset_pagination and
+                       ORDER_VAR not in self.params)
+        if not self.keyset:
+            return super(BalancedChangeList, self).get_results(request)
+
+        paginator = self.model_admin.get_paginator(
+            request, queryset, self.list_per_page)
+        rows = queryset.order_by('-created_at', '-pk')
+        created_at, _, pk = (self.cursor or '').partition('|')
+        created_at = parse_datetime(created_at) if created_at else None
+        if created_at is not None:
+            rows = rows.filter(Q(created_at__lt=created_at) |
+                               Q(created_at=created_at, pk__lt=pk))
+        rows = list(rows[:self.list_per_page + 1])
+        if len(rows) > self.list_per_page:
+            rows = rows[:self.list_per_page]
+            self.next_cursor = '%s|%s' % (rows[-1].created_at.isoformat(),
+                                          rows[-1].pk)
+        self.result_count = paginator.count
+        # django < 1.8 only shows the actions when the unfiltered list has
+        # rows, newer versions when it is counted at all
+        self.show_full_result_count = (
+            self.model_admin.show_full_result_count or
+            not hasattr(admin.ModelAdmin, 'show_full_result_count'))
+        self.full_result_count = None
+        if self.show_full_result_count:
+            root = getattr(self, 'root_%s' % name)
+            self.full_result_count = self.model_admin.get_paginator(
+                request, root, self.list_per_page).count
+        self.show_admin_actions = (not self.show_full_result_count or
+                                   bool(self.full_result_count))
+        self.result_list = rows
+        self.can_show_all = False
+        self.multi_page = bool(self.cursor or self.next_cursor)
+        self.paginator = paginator
+
+    def first_page_url(self):
+        return self.get_query_string(remove=[CURSOR_VAR])
+
+    def next_page_url(self):
+        return self.get_query_string({CURSOR_VAR: self.next_cursor})
+
+
+class UserLookupFilter(admin.SimpleListFilter):
+    """
+    Filters on a user typed in by username or id, rather than offering
+    every user as a choice.
+    """
+    title = 'user'
+    parameter_name = 'user'
+    template = 'django_balanced/admin_lookup_filter.html'
+
+    def lookups(self, request, model_admin):
+        return ()
+
+    def has_output(self):
+        return True
+
+    def queryset(self, request, queryset):
+        value = self.value()
+        if not value:
+            return queryset
+        if value.isdigit():
+            return queryset.filter(user__pk=value)
+        return queryset.filter(user__username=value)
+
+    def choices(self, cl):
+        yield {
+            'selected': self.value() is None,
+            'query_string': cl.get_query_string({}, [self.parameter_name]),
+            'display': 'All',
+            'params': [(k, v) for k, v in cl.params.items()
+                       if k != self.parameter_name],
+        }
+
+
+def _raw_id_widget(model, field_name):
+    # a text box with a lookup popup, a select would render the whole table
+    return ForeignKeyRawIdWidget(model._meta.get_field(field_name).rel,
+                                 admin.site)
+
+
 class BalancedAdmin(admin.ModelAdmin):
     add_fields = ()
     edit_fields = ()
+    paginator = EstimatedCountPaginator
+    keyset_pagination = True
+    # django >= 1.8, filtered lists skip counting the whole table
+    show_full_result_count = False
+    change_list_template = 'django_balanced/admin_change_list.html'
+    actions = ['export_csv_action', 'export_jsonl_action']
+
+    def export_csv_action(self, request, queryset):
+        return export.export_response(queryset, 'csv')
+
+    export_csv_action.short_description = 'Export selected as CSV'
+
+    def export_jsonl_action(self, request, queryset):
+        return export.export_response(queryset, 'jsonl')
+
+    export_jsonl_action.short_description = 'Export selected as JSON lines'
+
+    def get_changelist(self, request, **kwargs):
+        return BalancedChangeList
 
     def add_view(self, *args, **kwargs):
         self.fields = getattr(self, 'add_fields', self.fields)
@@ -38,7 +221,8 @@ class BankAccountAdminForm(forms.ModelForm):
     type = forms.ChoiceField(choices=(
         ('savings', 'savings'), ('checking', 'checking')
     ))
-    user = forms.ModelChoiceField(queryset=User.objects, required=False)
+    user = forms.ModelChoiceField(queryset=User.objects, required=False,
+                                  widget=_raw_id_widget(BankAccount, 'user'))
 
     class Meta:
         model = BankAccount
@@ -64,10 +248,11 @@ class BankAccountAdmin(BalancedAdmin):
     edit_fields = ('user',)
     list_display = ['account_number', 'created_at', 'user', 'name',
                     'bank_name', 'type', 'dashboard_link']
-    list_filter = ['type', 'bank_name', 'user']
+    list_select_related = ('user',)
+    list_filter = ['type', 'bank_name', 'marketplace', UserLookupFilter]
     search_fields = ['name', 'account_number']
     form = BankAccountAdminForm
-    actions = ['bulk_pay_action']
+    actions = BalancedAdmin.actions + ['bulk_pay_action']
 
     def bulk_pay_action(self, request, queryset):
         return render(request, 'django_balanced/admin_confirm_bulk_pay.html', {
@@ -81,7 +266,11 @@ class BankAccountAdmin(BalancedAdmin):
         my_urls = patterns('django_balanced.admin',
                            url(r'^bulk_pay/$',
                                self.admin_site.admin_view(self.bulk_pay_view),
-                               name='bank_account_bulk_pay')
+                               name='bank_account_bulk_pay'),
+                           url(r'^bulk_pay/(?P<batch_id>\d+)/$',
+                               self.admin_site.admin_view(
+                                   self.bulk_pay_status_view),
+                               name='bank_account_bulk_pay_status'),
                            )
         return my_urls + urls
 
@@ -103,13 +292,31 @@ class BankAccountAdmin(BalancedAdmin):
                 (bank_account, amount, description)
             )
             index += 1
-        balanced.bust_cache()
-        escrow = balanced.Marketplace.my_marketplace.in_escrow
-        if total > escrow:
-            raise Exception('You have insufficient funds.')
-        for bank_account, amount, description in charges:
-            bank_account.credit(amount, description)
-        return redirect(urlresolvers.reverse('admin:index'))
+        try:
+            reservation = escrow.reserve(total, user=request.user)
+        except escrow.InsufficientFunds as ex:
+            # another payout got there first, let the user pay less
+            messages.error(request, '%s' % ex)
+            return self.bulk_pay_action(
+                request, [bank_account for bank_account, _, _ in charges])
+        try:
+            batch = create_batch(charges, user=request.user,
+                                 reservation=reservation)
+        except Exception:
+            escrow.settle(reservation)
+            raise
+        run_batch_in_background(batch)
+        return redirect(urlresolvers.reverse(
+            'admin:bank_account_bulk_pay_status', args=(batch.pk,)))
+
+    def bulk_pay_status_view(self, request, batch_id):
+        batch = get_object_or_404(PayoutBatch, pk=batch_id)
+        return render(request, 'django_balanced/admin_bulk_pay_status.html', {
+            'batch': batch,
+            'progress': batch.progress(),
+            'failed_items': batch.items.filter(
+                status=PayoutItem.FAILED).select_related('bank_account'),
+        }, current_app=self.admin_site.name)
 
     def save_model(self, request, obj, form, change):
         data = form.data
@@ -125,7 +332,9 @@ class BankAccountAdmin(BalancedAdmin):
 class CreditAdminForm(forms.ModelForm):
     amount = forms.DecimalField(max_digits=10, required=True)
     description = forms.CharField(max_length=255, required=False)
-    bank_account = forms.ModelChoiceField(queryset=BankAccount.objects)
+    bank_account = forms.ModelChoiceField(
+        queryset=BankAccount.objects,
+        widget=_raw_id_widget(Credit, 'bank_account'))
 
     class Meta:
         model = Credit
@@ -134,10 +343,8 @@ class CreditAdminForm(forms.ModelForm):
         if not self.is_valid():
             return self.cleaned_data
         data = self.cleaned_data
-        balanced.bust_cache()
-        escrow = balanced.Marketplace.my_marketplace.in_escrow
         amount = int(float(data['amount']) * 100)
-        if amount > escrow:
+        if amount > escrow.available():
             raise forms.ValidationError('You have insufficient funds to cover '
                                         'this transfer.')
         return data
@@ -148,8 +355,10 @@ class CreditAdmin(BalancedAdmin):
     edit_fields = (None)
     list_display = ['user', 'bank_account', 'amount',
                     'description', 'status', 'dashboard_link']
+    # bank accounts print their user too
+    list_select_related = ('user', 'bank_account', 'bank_account__user')
     search_fields = ['amount', 'description', 'status']
-    list_filter = ['user', 'status']
+    list_filter = [UserLookupFilter, 'status', 'marketplace']
     form = CreditAdminForm
 
     def get_form(self, request, obj=None, **kwargs):
@@ -157,6 +366,15 @@ class CreditAdmin(BalancedAdmin):
             self.exclude = ('amount',)
         return super(CreditAdmin, self).get_form(request, obj=None, **kwargs)
 
+    def add_view(self, request, *args, **kwargs):
+        try:
+            return super(CreditAdmin, self).add_view(request, *args, **kwargs)
+        except escrow.InsufficientFunds as ex:
+            # the form checked the balance, but another payout took it
+            # before the amount was held
+            messages.error(request, '%s' % ex)
+            return HttpResponseRedirect(request.get_full_path())
+
     def save_model(self, request, obj, form, change):
         data = form.data
         amount = int(float(data['amount']) * 100)
@@ -165,7 +383,11 @@ class CreditAdmin(BalancedAdmin):
         obj.bank_account = bank_account
         obj.user = bank_account.user
         obj.description = data['description']
-        obj.save()
+        # the form only checked the balance, concurrent credits are only
+        # ruled out by holding the amount
+        with escrow.reserved(amount, user=request.user) as reservation:
+            obj.save()
+            reservation.spent = amount
 
 
 admin.site.register(BankAccount, BankAccountAdmin)
@@ -0,0 +1,20 @@
+"""
+asyncio counterparts of the model operations, for ASGI deployments.
+
+Requires python 3.5+, importing it on older versions raises ImportError.
+Each operation is handed to a dedicated pool of `BALANCED['ASYNC_WORKERS']`
+threads talking to Balanced over the pooled keep-alive transport, so the
+event loop never blocks on a payment and independent operations can run
+concurrently::
+
+    credits = await aio.gather_bounded(
+        *[aio.acredit(bank_account, 500) for bank_account in bank_accounts],
+        limit=20)
+"""
+from __future__ import unicode_literals
+import sys
+
+if sys.version_info < (3, 5):
+    raise ImportError('django_balanced.aio requires python 3.5 or later')
+
+from django_balanced._aio import *  # noqa
@@ -0,0 +1,36 @@
+"""
+Process startup of django_balanced: applies the default settings, points
+the `balanced` client at the pooled transport with the configured API key
+and connects the signal handlers. Django >= 1.7 runs it once from
+`BalancedConfig.ready()`, older versions when the models are imported.
+Nothing is left to do per request.
+"""
+from __future__ import unicode_literals
+
+
+def setup():
+    from django.conf import settings
+    from django.contrib.auth.models import User
+    from django.db.models.signals import post_save
+
+    from django_balanced import settings as defaults  # noqa
+    from django_balanced import transport
+    from django_balanced.models import create_user_profile
+
+    transport.configure()
+    if settings.BALANCED['PROVISION_ACCOUNTS'] == 'on_commit':
+        post_save.connect(create_user_profile, sender=User,
+                          dispatch_uid='django_balanced.create_user_profile')
+
+
+try:
+    from django.apps import AppConfig
+except ImportError:
+    AppConfig = None
+else:
+    class BalancedConfig(AppConfig):
+        name = 'django_balanced'
+        verbose_name = 'Balanced'
+
+        def ready(self):
+            setup()
@@ -0,0 +1,270 @@
+"""
+Offline benchmarks of the sync, payout and hydration paths, run against a
+`FakeBalanced` server so they need neither network access nor an API key.
+`manage.py balanced_benchmark` runs them in a throwaway database and prints
+the results as JSON, e.g. to compare against those of the previous release::
+
+    python manage.py balanced_benchmark --sizes 10000,100000,1000000 \\
+        --recipients 100,1000 --latency 20 --output benchmarks.json
+"""
+from __future__ import unicode_literals
+from contextlib import contextmanager
+from datetime import datetime
+import sys
+import time
+
+import balanced
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from django_balanced import (
+    __version__, cache, escrow, marketplace, metrics, throttle,
+)
+from django_balanced.fake import FakeBalanced
+from django_balanced.models import (
+    Account, BankAccount, Card, Credit, EscrowLedger, SyncWatermark,
+)
+from django_balanced.payouts import create_batch, run_batch
+from django_balanced.sync import sync_all
+
+
+def _percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def at(percent):
+        return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+    return {'p50': at(50), 'p95': at(95), 'p99': at(99), 'max': values[-1]}
+
+
+@contextmanager
+def _recording():
+    # collects the (name, kind, value) of every metric, from any thread
+    recorded = []
+
+    def receiver(sender, name, kind, value, **kwargs):
+        recorded.append((name, kind, value))
+
+    metrics.metric_recorded.connect(receiver)
+    try:
+        yield recorded
+    finally:
+        metrics.metric_recorded.disconnect(receiver)
+
+
+def _total_ms(recorded, name):
+    return sum(v for n, kind, v in recorded if n == name and kind == 'timing')
+
+
+@contextmanager
+def _overrides(**values):
+    saved = dict(settings.BALANCED)
+    settings.BALANCED.update(values)
+    throttle.reset()
+    try:
+        yield
+    finally:
+        settings.BALANCED.clear()
+        settings.BALANCED.update(saved)
+        throttle.reset()
+
+
+def _credit_factory(fake, owners):
+    def factory(index):
+        return {
+            'amount': 100 + index % 900,
+            'description': 'Benchmark credit %d' % index,
+            'bank_account_uri': fake.uri('bank_accounts', index % owners),
+        }
+    return factory
+
+
+def setup_owners(fake, count):
+    """
+    `count` users, each with a Balanced account and a bank account on
+    `fake`, synced into the local tables. Returns the bank accounts.
+    """
+    User.objects.bulk_create([
+        User(username='benchmark%d' % i) for i in range(count)
+    ])
+    fake.seed('accounts', count, lambda i: {'name': 'benchmark%d' % i})
+    fake.seed('bank_accounts', count, lambda i: {
+        'account_uri': fake.uri('accounts', i),
+        'name': 'Benchmark %d' % i,
+        'account_number': 'xxxxxx%04d' % (i % 10000),
+        'routing_number': '321174851',
+        'bank_name': 'BENCHMARK BANK',
+        'type': 'checking',
+    })
+    sync_all(models=[Account, BankAccount])
+    return list(BankAccount.objects.all())
+
+
+def bench_sync(fake, size, owners, workers=1, chunk_size=None):
+    """
+    Throughput of a full `Credit` sync of `size` remote credits.
+    """
+    fake.seed('credits', size, _credit_factory(fake, owners))
+    Credit.objects.all().delete()
+    SyncWatermark.objects.filter(resource=Credit.__name__).delete()
+    fake.reset_counts()
+    with _recording() as recorded:
+        started = time.time()
+        [(_, stats)] = sync_all(models=[Credit], workers=workers,
+                                chunk_size=chunk_size)
+        seconds = time.time() - started
+    return {
+        'resources': size,
+        'workers': workers,
+        'seconds': seconds,
+        'per_second': size / seconds if seconds else None,
+        'round_trips': fake.round_trips,
+        'errors': fake.errors,
+        'stats': stats,
+        'ms': dict((step, _total_ms(recorded, 'sync.%s' % step))
+                   for step in ('lookup', 'fingerprint', 'hydrate', 'write')),
+    }
+
+
+def bench_payouts(fake, bank_accounts, recipients, workers=None):
+    """
+    Latency of paying `recipients` bank accounts in one payout batch.
+    """
+    batch = create_batch([
+        (bank_account, 100 + i, 'Benchmark payout')
+        for i, bank_account in enumerate(bank_accounts[:recipients])
+    ])
+    fake.reset_counts()
+    with _recording() as recorded:
+        started = time.time()
+        run_batch(batch, workers)
+        seconds = time.time() - started
+    progress = batch.progress()
+    return {
+        'recipients': recipients,
+        'workers': workers or settings.BALANCED['PAYOUT_WORKERS'],
+        'seconds': seconds,
+        'per_second': recipients / seconds if seconds else None,
+        'paid': progress['paid'],
+        'failed': progress['failed'],
+        'round_trips': fake.round_trips,
+        'errors': fake.errors,
+        'credit_ms': _percentiles([v for n, kind, v in recorded
+                                   if n == 'remote.credit' and
+                                   kind == 'timing']),
+    }
+
+
+def bench_hydration(fake, size, owners):
+    """
+    Cost of copying remote credits onto model instances, without I/O.
+    """
+    factory = _credit_factory(fake, owners)
+    resources = []
+    for index in range(size):
+        attributes = factory(index)
+        attributes.update(id='CRfake%d' % index,
+                          uri='/v1/credits/CRfake%d' % index,
+                          created_at='2013-01-01T00:00:00.000000Z')
+        resources.append(balanced.Credit(**attributes))
+    started = time.time()
+    for resource in resources:
+        instance = Credit()
+        instance._sync(resource)
+        instance._sync_related(resource)
+    seconds = time.time() - started
+    return {
+        'resources': size,
+        'seconds': seconds,
+        'us_per_resource': seconds * 1e6 / size if size else None,
+    }
+
+
+def bench_round_trips(fake, bank_account, chunk_size=None):
+    """
+    Requests sent to Balanced by each common operation.
+    """
+    chunk_size = chunk_size or settings.BALANCED['SYNC_CHUNK_SIZE']
+    user = bank_account.user
+    account = Account.for_user(user)
+    fake.seed('cards', 1, lambda i: {'account_uri': account.uri})
+    card = Card(uri=fake.uri('cards', 0), id='CCfake0', user=user,
+                created_at=datetime(2013, 1, 1), name='Benchmark',
+                expiration_month=12, expiration_year=2020, last_four='1111',
+                brand='Visa')
+    Card.objects.bulk_create([card])
+    cache.invalidate(bank_account.uri)
+    EscrowLedger.objects.all().delete()
+    # count looking up the marketplace too
+    marketplace._marketplace_uris.pop(balanced.config.api_key_secret, None)
+
+    def count(operation, *args, **kwargs):
+        fake.reset_counts()
+        operation(*args, **kwargs)
+        return fake.round_trips
+
+    def sync_chunk():
+        fake.seed('credits', chunk_size, _credit_factory(fake, 1))
+        SyncWatermark.objects.filter(resource=Credit.__name__).delete()
+        Credit.sync(chunk_size)
+
+    new_user = User.objects.create(username='benchmark-new')
+    return {
+        'find': count(bank_account.find),
+        'find_cached': count(bank_account.find),
+        'escrow': count(escrow.available),
+        'escrow_cached': count(escrow.available),
+        'credit': count(bank_account.credit, 100),
+        'debit': count(account.debit, 100, 'Benchmark', card=card),
+        'provision_account': count(Account.for_user, new_user),
+        'sync_chunk': count(sync_chunk),
+    }
+
+
+def run_benchmarks(sizes=(10000,), recipients=(100,), workers=1,
+                   payout_workers=None, chunk_size=None, latency=0,
+                   error_rate=0, seed=0):
+    """
+    Runs every benchmark against a fresh `FakeBalanced`, answering after
+    `latency` seconds and failing at `error_rate`. Writes to the default
+    database, which should be a throwaway one. Rate limiting is turned off,
+    to measure the code rather than the limits.
+
+    Returns the results as a JSON serializable dict.
+    """
+    sizes, recipients = list(sizes), list(recipients)
+    results = {
+        'version': __version__,
+        'python': sys.version.split()[0],
+        'django': django.get_version(),
+        'started_at': datetime.utcnow().isoformat(),
+        'options': {
+            'sizes': sizes,
+            'recipients': recipients,
+            'workers': workers,
+            'payout_workers': payout_workers,
+            'chunk_size': chunk_size or settings.BALANCED['SYNC_CHUNK_SIZE'],
+            'latency': latency,
+            'error_rate': error_rate,
+        },
+    }
+    owners = max(recipients + [1])
+    with _overrides(RATE_LIMIT=0):
+        with FakeBalanced(latency, error_rate, seed=seed) as fake:
+            bank_accounts = setup_owners(fake, owners)
+            results['hydration'] = bench_hydration(
+                fake, min(max(sizes), 100000), owners)
+            results['sync'] = [
+                bench_sync(fake, size, owners, workers, chunk_size)
+                for size in sizes
+            ]
+            results['payouts'] = [
+                bench_payouts(fake, bank_accounts, count, payout_workers)
+                for count in recipients
+            ]
+            results['round_trips'] = bench_round_trips(
+                fake, bank_accounts[0], chunk_size)
+    return results
@@ -0,0 +1,91 @@
+from __future__ import unicode_literals
+from contextlib import contextmanager
+import threading
+
+from django.conf import settings
+
+from django_balanced import metrics, tenants
+
+try:
+    from django.core.cache import caches
+except ImportError:  # django < 1.7
+    from django.core.cache import get_cache
+else:
+    def get_cache(alias):
+        return caches[alias]
+
+
+_local = threading.local()
+
+
+def get_backend():
+    return get_cache(tenants.current().cache_alias or
+                     settings.BALANCED['CACHE_ALIAS'])
+
+
+def _key(uri):
+    return tenants.current().qualify('django_balanced:%s' % uri)
+
+
+def _identity_map():
+    return getattr(_local, 'resources', None)
+
+
+@contextmanager
+def resource_scope():
+    """
+    Within this block every remote resource is fetched at most once per
+    thread, further lookups return the same object. `BalancedMiddleware`
+    opens one scope per request; wrap jobs in their own.
+    """
+    outer = _identity_map()
+    _local.resources = {} if outer is None else outer
+    try:
+        yield _local.resources
+    finally:
+        _local.resources = outer
+
+
+def find(resource_cls, uri, fresh=False):
+    """
+    Read-through lookup of the remote resource at `uri`: the current
+    `resource_scope`, then the django cache (for `BALANCED['CACHE_TTL']`
+    seconds, 0 disables it), then the Balanced API. `fresh` always asks
+    the API, for reads that are about to be written back; what it returns
+    replaces the copies held so far.
+    """
+    resources = _identity_map()
+    if not fresh and resources is not None and uri in resources:
+        return resources[uri]
+    ttl = settings.BALANCED['CACHE_TTL']
+    resource = get_backend().get(_key(uri)) if ttl and not fresh else None
+    if resource is None:
+        with metrics.operation('find'):
+            resource = resource_cls.find(uri)
+        if ttl:
+            get_backend().set(_key(uri), resource, ttl)
+    if resources is not None:
+        resources[uri] = resource
+    return resource
+
+
+def store(resource):
+    """
+    Replaces the cached copy of `resource` after it was written, e.g. with
+    the representation returned by a POST or PUT.
+    """
+    resources = _identity_map()
+    if resources is not None:
+        resources[resource.uri] = resource
+    ttl = settings.BALANCED['CACHE_TTL']
+    if ttl:
+        get_backend().set(_key(resource.uri), resource, ttl)
+
+
+def invalidate(*uris):
+    resources = _identity_map()
+    for uri in uris:
+        if resources is not None:
+            resources.pop(uri, None)
+    if settings.BALANCED['CACHE_TTL']:
+        get_backend().delete_many([_key(uri) for uri in uris])
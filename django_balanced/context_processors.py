@@ -1,13 +1,13 @@
 from __future__ import unicode_literals
-import balanced
-
 from django.conf import settings
 
+from django_balanced.marketplace import get_marketplace_uri
+
 
 def balanced_settings(request):
     return {
         'BALANCED': {
-            'MARKETPLACE_URI': balanced.Marketplace.my_marketplace.uri,
+            'MARKETPLACE_URI': get_marketplace_uri(),
             'DASHBOARD_URL': settings.BALANCED['DASHBOARD_URL'],
             'API_URL': settings.BALANCED['DASHBOARD_URL'],
         },
@@ -15,6 +15,7 @@ def balanced_settings(request):
 
 
 def balanced_library(request):
+    import balanced
     return {
         'balanced': balanced,
     }
@@ -0,0 +1,120 @@
+"""
+A local ledger of the marketplace's escrow, so payouts are admitted without
+asking Balanced for the balance every time and concurrent payouts never
+overdraw it::
+
+    with escrow.reserved(2500, user=request.user) as reservation:
+        bank_account.credit(2500)
+        reservation.spent = 2500
+
+Reservations lock the ledger row only while checking and holding the
+amount. The balance is read from Balanced the first time, and again when a
+reservation does not fit, as funds may have come in since. Credits sent
+under a reservation that is still held are then counted twice, which errs
+on the side of refusing a payout.
+"""
+from __future__ import unicode_literals
+from contextlib import contextmanager
+
+from django.utils import timezone
+
+from django_balanced.marketplace import get_marketplace_uri, refresh_escrow
+from django_balanced.models import (
+    BalancedException, EscrowLedger, EscrowReservation, _atomic,
+)
+
+
+class InsufficientFunds(BalancedException):
+    pass
+
+
+def _locked_ledger(uri=None):
+    uri = uri or get_marketplace_uri()
+    EscrowLedger.objects.get_or_create(marketplace_uri=uri)
+    return EscrowLedger.objects.select_for_update().get(pk=uri)
+
+
+def refresh():
+    """
+    Re-reads the escrow balance from Balanced. Amounts settled while the
+    balance is read are taken out of it again, whether it counts them yet
+    or not.
+    """
+    uri = get_marketplace_uri()
+    before = EscrowLedger.objects.filter(pk=uri).values_list('balance',
+                                                             flat=True)
+    before = before[0] if before else 0
+    balance = refresh_escrow()
+    with _atomic():
+        ledger = _locked_ledger(uri)
+        ledger.balance = balance + ledger.balance - before
+        ledger.refreshed_at = timezone.now()
+        ledger.save()
+    return ledger
+
+
+def available():
+    """
+    Cents of escrow not held by any reservation.
+    """
+    try:
+        ledger = EscrowLedger.objects.get(pk=get_marketplace_uri())
+    except EscrowLedger.DoesNotExist:
+        ledger = None
+    if ledger is None or ledger.refreshed_at is None:
+        ledger = refresh()
+    return ledger.balance - ledger.reserved
+
+
+def reserve(amount, user=None):
+    """
+    Holds `amount` cents of escrow until the reservation is settled, or
+    raises `InsufficientFunds`.
+    """
+    for attempt in range(2):
+        with _atomic():
+            ledger = _locked_ledger()
+            fits = ledger.balance - ledger.reserved >= amount
+            if ledger.refreshed_at is not None and fits:
+                ledger.reserved += amount
+                ledger.save()
+                return EscrowReservation.objects.create(
+                    ledger=ledger, amount=amount, created_by=user)
+        # never hold the lock while talking to balanced
+        if not attempt:
+            refresh()
+    raise InsufficientFunds('You have insufficient funds to cover %d' %
+                            amount)
+
+
+def settle(reservation, spent=0):
+    """
+    Ends `reservation`, taking the `spent` cents out of the balance and
+    releasing the rest. Settling twice does nothing.
+    """
+    with _atomic():
+        ledger = _locked_ledger(reservation.ledger_id)
+        reservation = EscrowReservation.objects.get(pk=reservation.pk)
+        if reservation.status != EscrowReservation.HELD:
+            return reservation
+        ledger.reserved -= reservation.amount
+        ledger.balance -= spent
+        ledger.save()
+        reservation.spent = spent
+        reservation.status = EscrowReservation.SETTLED
+        reservation.settled_at = timezone.now()
+        reservation.save()
+    return reservation
+
+
+@contextmanager
+def reserved(amount, user=None):
+    """
+    Holds `amount` cents for the block and settles the reservation with
+    whatever the block set as its `spent` when leaving, nothing by default.
+    """
+    reservation = reserve(amount, user)
+    try:
+        yield reservation
+    finally:
+        settle(reservation, reservation.spent)
@@ -0,0 +1,135 @@
+from __future__ import unicode_literals
+import json
+import logging
+
+from django.conf import settings
+from django.db.models import F, Max
+from django.utils import timezone
+
+from django_balanced import tenants
+from django_balanced.models import (
+    BalancedEvent, BalancedResource, _ChunkProgress, _atomic,
+    _local_datetime,
+)
+from django_balanced.sync import sync_models
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def record_event(payload):
+    """
+    Stores a callback `payload` for the current tenant unless an event with
+    its id was already received. Returns whether it was new.
+    """
+    entity = payload.get('entity') or {}
+    _, created = BalancedEvent.objects.get_or_create(
+        id=payload['id'],
+        defaults={
+            'type': payload.get('type', ''),
+            'entity_uri': entity.get('uri'),
+            'marketplace': tenants.current().name,
+            'payload': json.dumps(payload),
+            'occurred_at': _local_datetime(payload.get('occurred_at')),
+        },
+    )
+    return created
+
+
+def _model_for(uri):
+    # e.g. /v1/marketplaces/MP1/accounts/AC1/credits/CR1 is a credit
+    collection = uri.rstrip('/').split('/')[-2]
+    for model in BalancedResource.__subclasses__():
+        if model._resource.RESOURCE['collection'] == collection:
+            return model
+    return None
+
+
+def _order(event):
+    return (event.occurred_at is not None, event.occurred_at,
+            event.received_at)
+
+
+def drain_events(batch_size=None):
+    """
+    Applies up to `batch_size` unprocessed events (defaults to
+    `BALANCED['SYNC_CHUNK_SIZE']`) to the local tables and returns how many
+    were processed. Each entity is written once per batch with the state of
+    its latest event, using the same bulk upsert as `sync`, as the tenant
+    the event was received for. Events older than one already applied to
+    their entity are skipped, events about nothing stored locally ignored.
+
+    Events that cannot be applied yet, as a related row is missing locally
+    or their marketplace is not configured, stay unprocessed and are tried
+    again after the events received since. The events of a batch are
+    locked until it is done, so concurrent drains never apply them twice.
+    """
+    batch_size = batch_size or settings.BALANCED['SYNC_CHUNK_SIZE']
+    with _atomic():
+        events = list(BalancedEvent.objects.select_for_update().filter(
+            processed_at__isnull=True,
+        ).order_by('attempts', 'occurred_at', 'received_at')[:batch_size])
+        done, applied, failed = [], [], []
+        latest = {}
+        for event in events:
+            model = event.entity_uri and _model_for(event.entity_uri)
+            entity = model and json.loads(event.payload).get('entity')
+            if not entity:
+                if event.entity_uri and not model:
+                    LOGGER.warning('Ignoring event %s about %s, which is '
+                                   'not stored locally', event.id,
+                                   event.entity_uri)
+                done.append(event)
+                continue
+            current = latest.get(event.entity_uri)
+            if current is not None and _order(current[0]) > _order(event):
+                done.append(event)
+                continue
+            if current is not None:
+                done.append(current[0])
+            latest[event.entity_uri] = event, model, entity
+        applied_at = dict(BalancedEvent.objects.filter(
+            entity_uri__in=list(latest), processed_at__isnull=False,
+        ).values_list('entity_uri').annotate(Max('occurred_at')))
+        pending = {}
+        for uri, (event, model, entity) in latest.items():
+            if event.occurred_at is not None and \
+                    applied_at.get(uri) is not None and \
+                    applied_at[uri] > event.occurred_at:
+                # a newer state of the entity was written already
+                done.append(event)
+            else:
+                pending.setdefault(event.marketplace, {}).setdefault(
+                    model, []).append((event, entity))
+        for marketplace, by_model in pending.items():
+            try:
+                tenant = tenants.get(marketplace)
+            except tenants.UnknownTenant:
+                LOGGER.error('Keeping the events of marketplace %s, which '
+                             'is not configured', marketplace)
+                for model_events in by_model.values():
+                    failed.extend(event for event, _ in model_events)
+                continue
+            with tenants.activate(tenant):
+                # write rows in foreign key order, e.g. bank accounts
+                # before credits
+                for wave in sync_models():
+                    for model in wave:
+                        if model not in by_model:
+                            continue
+                        progress = _ChunkProgress()
+                        model._sync_chunk([
+                            model._resource(**entity)
+                            for _, entity in by_model[model]], progress)
+                        for event, _ in by_model[model]:
+                            if event.entity_uri in progress.unresolved:
+                                failed.append(event)
+                            else:
+                                applied.append(event)
+        BalancedEvent.objects.filter(
+            pk__in=[event.pk for event in done + applied],
+        ).update(processed_at=timezone.now())
+        BalancedEvent.objects.filter(
+            pk__in=[event.pk for event in failed],
+        ).update(attempts=F('attempts') + 1)
+    return len(done) + len(applied)
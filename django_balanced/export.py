@@ -0,0 +1,123 @@
+"""
+Streams credits, debits, bank accounts and cards out as CSV or JSON lines::
+
+    rows = export.filter_rows(Credit.objects.all(), since=since,
+                              statuses=['paid'])
+    for line in export.export(rows, 'jsonl'):
+        out.write(line)
+
+Rows are read in pages of `BALANCED['EXPORT_CHUNK_SIZE']` following the
+primary key, so memory stays flat and the first line is ready after the
+first page however big the table is. `QuerySet.iterator()` is not used as
+most databases and older versions of django buffer its whole result.
+"""
+from __future__ import unicode_literals
+import csv
+from datetime import date
+import json
+
+from django import http
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.encoding import smart_str
+
+
+FORMATS = ('csv', 'jsonl')
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+# internal bookkeeping, not part of the exported records
+SKIPPED_FIELDS = ('fingerprint',)
+
+# django < 1.5 streams a plain response built from an iterator
+StreamingHttpResponse = getattr(http, 'StreamingHttpResponse',
+                                http.HttpResponse)
+
+
+def export_fields(model):
+    return [f for f in model._meta.fields if f.name not in SKIPPED_FIELDS]
+
+
+def filter_rows(queryset, since=None, until=None, statuses=None):
+    """
+    Narrows `queryset` to the rows created from `since` until before
+    `until`, with one of `statuses`. Raises `ValueError` for a status
+    filter on a model without one.
+    """
+    if since is not None:
+        queryset = queryset.filter(created_at__gte=since)
+    if until is not None:
+        queryset = queryset.filter(created_at__lt=until)
+    if statuses:
+        if 'status' not in queryset.model._meta.get_all_field_names():
+            raise ValueError('%s have no status' %
+                             queryset.model._meta.verbose_name_plural)
+        queryset = queryset.filter(status__in=statuses)
+    return queryset
+
+
+def _rows(queryset, names, chunk_size):
+    queryset = queryset.order_by('pk').values_list('pk', *names)
+    last = None
+    while True:
+        page = queryset if last is None else queryset.filter(pk__gt=last)
+        page = list(page[:chunk_size])
+        if not page:
+            return
+        for row in page:
+            yield row[1:]
+        last = page[-1][0]
+
+
+class _Echo(object):
+    # a file for csv.writer that hands back each line instead of storing it
+
+    def write(self, value):
+        return value
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, date):
+        value = value.isoformat()
+    return smart_str(value)
+
+
+def export(queryset, format='csv', chunk_size=None):
+    """
+    Generates the rows of `queryset` as lines of `format`, 'csv' with a
+    header line or 'jsonl'. Foreign keys are written as their ids.
+    """
+    if format not in FORMATS:
+        raise ValueError('Unknown export format %s' % format)
+    return _lines(queryset, format,
+                  chunk_size or settings.BALANCED['EXPORT_CHUNK_SIZE'])
+
+
+def _lines(queryset, format, chunk_size):
+    fields = export_fields(queryset.model)
+    names = [f.attname for f in fields]
+    rows = _rows(queryset, [f.name for f in fields], chunk_size)
+    if format == 'csv':
+        writer = csv.writer(_Echo())
+        yield writer.writerow([smart_str(name) for name in names])
+        for row in rows:
+            yield writer.writerow([_csv_value(value) for value in row])
+    else:
+        for row in rows:
+            yield smart_str(json.dumps(dict(zip(names, row)),
+                                       cls=DjangoJSONEncoder,
+                                       sort_keys=True) + '\n')
+
+
+def export_response(queryset, format='csv', chunk_size=None):
+    """
+    A response streaming `export(queryset, format)` as an attachment.
+    """
+    response = StreamingHttpResponse(export(queryset, format, chunk_size),
+                                     content_type=CONTENT_TYPES[format])
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (
+        queryset.model._meta.db_table, format)
+    return response
@@ -0,0 +1,395 @@
+"""
+An in-process stand-in for the Balanced REST API, for tests and benchmarks
+that must not touch the network::
+
+    with FakeBalanced(latency=0.02) as fake:
+        fake.seed('accounts', 1000, lambda i: {'name': 'user%d' % i})
+        Account.sync()
+
+Every collection supports paginated queries (`offset`, `limit`, `sort` and
+`created_at[>=]` style filters), creating resources with POST, nested under
+their parent or not, and finding, updating and deleting them by uri.
+Seeded resources are built on demand, so collections of millions of
+resources cost no memory.
+"""
+from __future__ import unicode_literals
+from datetime import datetime, timedelta
+import json
+import math
+import random
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl, urlencode, urlsplit
+except ImportError:  # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import urlencode
+    from urlparse import parse_qsl, urlsplit
+
+import balanced
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from django_balanced import marketplace, transport
+
+
+# resources are created one second apart from here on
+EPOCH = datetime(2013, 1, 1)
+
+PREFIXES = {
+    'accounts': 'AC',
+    'bank_accounts': 'BA',
+    'cards': 'CC',
+    'credits': 'CR',
+    'debits': 'WD',
+    'events': 'EV',
+    'marketplaces': 'MP',
+}
+
+DEFAULTS = {
+    'credits': {'status': 'paid'},
+    'debits': {'status': 'succeeded'},
+    'marketplaces': {'in_escrow': 0},
+}
+
+STATUSES = dict((code, messages[0]) for code, messages
+                in BaseHTTPRequestHandler.responses.items())
+STATUSES.setdefault(429, 'Too Many Requests')  # python 2 lacks it
+
+
+def _singular(collection):
+    return collection[:-1] if collection.endswith('s') else collection
+
+
+def _error(status, category_code, description):
+    # the body balanced answers failed requests with
+    return {
+        'status': STATUSES.get(status, 'Error'),
+        'status_code': status,
+        'category_code': category_code,
+        'description': description,
+    }
+
+
+def _timestamp(index):
+    created_at = EPOCH + timedelta(seconds=index)
+    return created_at.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def _seconds(value):
+    # seconds between EPOCH and a created_at filter value
+    value = parse_datetime(value)
+    if timezone.is_aware(value):
+        value = timezone.make_naive(value, timezone.utc)
+    delta = value - EPOCH
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+def _lookup(resource, field):
+    # dotted fields such as meta.idempotency_key look into nested objects
+    value = resource
+    for key in field.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+class _Collection(object):
+    """
+    The resources of one type, the n-th being created n seconds after
+    `EPOCH`. The first `seeded` are built by a factory when read, the rest
+    were POSTed and are kept.
+    """
+
+    def __init__(self, name, seeded=0, factory=None):
+        self.name = name
+        self.prefix = PREFIXES.get(name, name[:2].upper())
+        self.seeded = seeded
+        self.factory = factory
+        self.created = []
+        self.changes = {}
+        self.deleted = set()
+
+    def __len__(self):
+        return self.seeded + len(self.created)
+
+    def __getitem__(self, index):
+        resource = dict(DEFAULTS.get(self.name, {}))
+        if index < self.seeded:
+            resource.update(self.factory(index))
+        else:
+            resource.update(self.created[index - self.seeded])
+        resource.update(self.changes.get(index, {}))
+        resource.update(
+            _type=_singular(self.name),
+            id=self.id(index),
+            uri=self.uri(index),
+            created_at=_timestamp(index),
+        )
+        return resource
+
+    def id(self, index):
+        return '%sfake%d' % (self.prefix, index)
+
+    def uri(self, index):
+        return '/v1/%s/%s' % (self.name, self.id(index))
+
+    def index(self, id):
+        number = id[len(self.prefix) + 4:]
+        if not id.startswith(self.prefix + 'fake') or not number.isdigit():
+            return None
+        number = int(number)
+        if number >= len(self) or number in self.deleted:
+            return None
+        return number
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def log_message(self, *args):
+        pass
+
+    def _handle(self, method):
+        fake = self.server.fake
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        params = json.loads(body.decode('utf-8')) if body else {}
+        status, payload, headers = fake.respond(method, self.path, params)
+        data = json.dumps(payload).encode('utf-8') if payload else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeBalanced(object):
+    """
+    Serves a fake Balanced API from a local thread. Each request is delayed
+    by `latency` seconds and fails with `error_status` at `error_rate`
+    (0 to 1), drawn from a random generator seeded with `seed`.
+    """
+
+    def __init__(self, latency=0, error_rate=0, error_status=500, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.collections = {}
+        self.requests = dict.fromkeys(('GET', 'POST', 'PUT', 'DELETE'), 0)
+        self.errors = 0
+        self.server = None
+        self.create('marketplaces', name='Fake marketplace')
+
+    def collection(self, name):
+        with self.lock:
+            if name not in self.collections:
+                self.collections[name] = _Collection(name)
+            return self.collections[name]
+
+    def seed(self, collection, count, factory=None):
+        """
+        Replaces `collection` with `count` resources whose attributes
+        `factory(index)` returns.
+        """
+        with self.lock:
+            self.collections[collection] = _Collection(
+                collection, count, factory or (lambda index: {}))
+
+    def create(self, collection, **attributes):
+        collection = self.collection(collection)
+        with self.lock:
+            collection.created.append(attributes)
+            index = len(collection) - 1
+        return collection[index]
+
+    def uri(self, collection, index):
+        return self.collection(collection).uri(index)
+
+    @property
+    def round_trips(self):
+        return sum(self.requests.values())
+
+    def reset_counts(self):
+        with self.lock:
+            for method in self.requests:
+                self.requests[method] = 0
+            self.errors = 0
+
+    def respond(self, method, path, data):
+        """
+        The `(status, payload, headers)` answering a request.
+        """
+        with self.lock:
+            self.requests[method] += 1
+            failed = self.random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            return self.error_status, _error(
+                self.error_status, 'injected-failure',
+                'Failure injected by FakeBalanced',
+            ), {'Retry-After': '0'} if self.error_status == 429 else {}
+
+        url = urlsplit(path)
+        parts = [p for p in url.path.split('/') if p]
+        if parts and parts[0] == 'v1':
+            parts = parts[1:]
+        if not parts:
+            return 404, None, {}
+        if len(parts) % 2:
+            name, id, parent = parts[-1], None, parts[:-1]
+        else:
+            name, id, parent = parts[-2], parts[-1], parts[:-2]
+        # everything belongs to the one marketplace
+        if parent and parent[-2] != 'marketplaces':
+            parent = ('%s_uri' % _singular(parent[-2]),
+                      '/v1/%s/%s' % (parent[-2], parent[-1]))
+        else:
+            parent = None
+        collection = self.collection(name)
+
+        if id is None and method == 'GET':
+            return 200, self._page(collection, parent,
+                                   dict(parse_qsl(url.query))), {}
+        if id is None and method == 'POST':
+            if parent is not None:
+                data[parent[0]] = parent[1]
+            return 201, self.create(name, **data), {}
+        index = collection.index(id) if id is not None else None
+        if index is None:
+            return 404, _error(404, 'not-found', '%s not found' % path), {}
+        if method == 'PUT':
+            with self.lock:
+                collection.changes.setdefault(index, {}).update(data)
+        elif method == 'DELETE':
+            with self.lock:
+                collection.deleted.add(index)
+            return 204, None, {}
+        return 200, collection[index], {}
+
+    def _page(self, collection, parent, params):
+        query = dict(params)
+        offset = int(params.pop('offset', 0))
+        limit = int(params.pop('limit', 10))
+        descending = params.pop('sort', '').endswith('desc')
+        with self.lock:
+            low, high = 0, len(collection)
+        filters = []
+        for key, value in params.items():
+            field, operator = key, '='
+            if key.endswith(']') and '[' in key:
+                field, operator = key[:-1].split('[', 1)
+            # resources are ordered by created_at, so ranges are arithmetic
+            if field == 'created_at' and operator in ('>=', '>', '<=', '<'):
+                seconds = _seconds(value)
+                if operator == '>=':
+                    low = max(low, int(math.ceil(seconds)))
+                elif operator == '>':
+                    low = max(low, int(math.floor(seconds)) + 1)
+                elif operator == '<=':
+                    high = min(high, int(math.floor(seconds)) + 1)
+                else:
+                    high = min(high, int(math.ceil(seconds)))
+            else:
+                filters.append((field, value))
+        if parent is not None:
+            filters.append(parent)
+        high = max(low, high)
+
+        indexes = None
+        if filters or collection.deleted:
+            indexes = [
+                i for i in range(low, high)
+                if i not in collection.deleted and all(
+                    '%s' % _lookup(collection[i], f) == v for f, v in filters)
+            ]
+            total = len(indexes)
+        else:
+            total = high - low
+        items = []
+        for position in range(offset, min(offset + limit, total)):
+            if descending:
+                position = total - 1 - position
+            if indexes is not None:
+                items.append(collection[indexes[position]])
+            else:
+                items.append(collection[low + position])
+
+        def page_uri(page_offset):
+            if page_offset is None:
+                return None
+            params = dict(query, offset=page_offset, limit=limit)
+            return '/v1/%s?%s' % (collection.name,
+                                  urlencode(sorted(params.items())))
+
+        last = max(0, (total - 1) // limit * limit) if limit else 0
+        return {
+            '_type': 'page',
+            'items': items,
+            'total': total,
+            'offset': offset,
+            'limit': limit,
+            'uri': page_uri(offset),
+            'first_uri': page_uri(0),
+            'last_uri': page_uri(last),
+            'previous_uri': page_uri(offset - limit if offset else None),
+            'next_uri': page_uri(
+                offset + limit if offset + limit < total else None),
+        }
+
+    def start(self):
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.server.fake = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return 'http://127.0.0.1:%d' % self.server.server_port
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+
+    def __enter__(self):
+        # point the client at the fake, under a key of its own so nothing
+        # learnt about the fake marketplace leaks into real calls
+        self._config = (balanced.config.root_uri,
+                        balanced.config.api_key_secret)
+        transport.install()
+        balanced.config.root_uri = self.start()
+        balanced.config.api_key_secret = 'fake'
+        return self
+
+    def __exit__(self, *exc_info):
+        marketplace._marketplace_uris.pop('fake', None)
+        balanced.config.root_uri, balanced.config.api_key_secret = \
+            self._config
+        self.stop()
@@ -0,0 +1,94 @@
+from __future__ import unicode_literals
+from optparse import make_option
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from django_balanced.benchmarks import run_benchmarks
+
+
+def _numbers(value):
+    return [int(n) for n in value.split(',') if n.strip()]
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks syncs, bulk payouts and hydration against a local ' \
+           'fake of the Balanced API, in a throwaway test database'
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes',
+                    dest='sizes',
+                    default='10000',
+                    help='Comma separated numbers of credits to sync'),
+        make_option('--recipients',
+                    dest='recipients',
+                    default='100',
+                    help='Comma separated numbers of bank accounts to pay '
+                         'in one batch'),
+        make_option('--workers',
+                    dest='workers',
+                    type='int',
+                    default=1,
+                    help='Number of threads syncing concurrently, needs a '
+                         'database the threads can share'),
+        make_option('--payout-workers',
+                    dest='payout_workers',
+                    type='int',
+                    default=None,
+                    help='Number of credits sent concurrently'),
+        make_option('--chunk-size',
+                    dest='chunk_size',
+                    type='int',
+                    default=None,
+                    help='Number of resources written per transaction'),
+        make_option('--latency',
+                    dest='latency',
+                    type='float',
+                    default=0,
+                    help='Milliseconds the fake API takes to answer'),
+        make_option('--error-rate',
+                    dest='error_rate',
+                    type='float',
+                    default=0,
+                    help='Share of requests the fake API fails, 0 to 1'),
+        make_option('--output',
+                    dest='output',
+                    default=None,
+                    help='File to write the JSON results to, instead of '
+                         'standard output'),
+        make_option('--noinput',
+                    action='store_false',
+                    dest='interactive',
+                    default=True,
+                    help='Replace a leftover test database without asking'),
+    )
+
+    def handle(self, *args, **options):
+        if connection.vendor == 'sqlite':
+            # the in-memory test database is private to each thread
+            if options['workers'] > 1 or (options['payout_workers'] or 1) > 1:
+                raise CommandError('sqlite test databases cannot be shared '
+                                   'between worker threads')
+            options['payout_workers'] = 1
+        old_name = settings.DATABASES['default']['NAME']
+        connection.creation.create_test_db(
+            verbosity=0, autoclobber=not options['interactive'])
+        try:
+            results = run_benchmarks(
+                sizes=_numbers(options['sizes']),
+                recipients=_numbers(options['recipients']),
+                workers=options['workers'],
+                payout_workers=options['payout_workers'],
+                chunk_size=options['chunk_size'],
+                latency=options['latency'] / 1000.0,
+                error_rate=options['error_rate'],
+            )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output + '\n')
@@ -0,0 +1,81 @@
+from __future__ import unicode_literals
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_balanced import export
+from django_balanced.management.utils import get_tenant, parse_date
+from django_balanced.models import BankAccount, Card, Credit, Debit
+
+
+MODELS = {
+    'bank_account': BankAccount,
+    'card': Card,
+    'credit': Credit,
+    'debit': Debit,
+}
+
+
+class Command(BaseCommand):
+    args = 'credit|debit|bank_account|card'
+    help = 'Streams the local credits, debits, bank accounts or cards out ' \
+           'as CSV or JSON lines'
+    option_list = BaseCommand.option_list + (
+        make_option('--format',
+                    dest='format',
+                    default='csv',
+                    help='csv or jsonl'),
+        make_option('--since',
+                    dest='since',
+                    default=None,
+                    help='First day to export, YYYY-MM-DD'),
+        make_option('--until',
+                    dest='until',
+                    default=None,
+                    help='Day to stop before, YYYY-MM-DD'),
+        make_option('--status',
+                    dest='statuses',
+                    action='append',
+                    default=[],
+                    help='Only export rows with this status, may be given '
+                         'more than once'),
+        make_option('--chunk-size',
+                    dest='chunk_size',
+                    type='int',
+                    default=None,
+                    help='Number of rows read per query'),
+        make_option('--output',
+                    dest='output',
+                    default=None,
+                    help='File to write to, instead of standard output'),
+        make_option('--marketplace',
+                    dest='marketplace',
+                    default=None,
+                    help='Name of the marketplace in BALANCED MARKETPLACES '
+                         'to export, instead of the API_KEY one'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or args[0].lower() not in MODELS:
+            raise CommandError('Export one of %s' % ', '.join(sorted(MODELS)))
+        tenant = get_tenant(options['marketplace'])
+        since, until = options['since'], options['until']
+        try:
+            rows = export.filter_rows(
+                MODELS[args[0].lower()].objects.for_marketplace(tenant.name),
+                since=parse_date(since) if since else None,
+                until=parse_date(until) if until else None,
+                statuses=options['statuses'],
+            )
+            lines = export.export(rows, options['format'],
+                                  options['chunk_size'])
+        except ValueError as ex:
+            raise CommandError(ex)
+        output = open(options['output'], 'w') if options['output'] else \
+            self.stdout
+        try:
+            for line in lines:
+                output.write(line)
+        finally:
+            if options['output']:
+                output.close()
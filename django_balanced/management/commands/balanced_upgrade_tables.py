@@ -0,0 +1,168 @@
+from __future__ import unicode_literals
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+
+from django_balanced.models import Account, Debit, _atomic
+
+try:
+    basestring
+except NameError:  # python 3
+    basestring = str
+
+
+def _app_models():
+    try:
+        from django.apps import apps
+    except ImportError:  # django < 1.7
+        from django.db.models import get_app, get_models
+        return get_models(get_app('django_balanced'))
+    return apps.get_app_config('django_balanced').get_models()
+
+
+def _missing_columns():
+    cursor = connection.cursor()
+    tables = connection.introspection.table_names(cursor)
+    missing = []
+    for model in _app_models():
+        table = model._meta.db_table
+        if table not in tables:
+            # syncdb creates it whole
+            continue
+        columns = set(row[0] for row in connection.introspection
+                      .get_table_description(cursor, table))
+        missing.extend((model, field) for field in model._meta.local_fields
+                       if field.column not in columns)
+    return missing
+
+
+def _single_account_constraints():
+    # accounts were unique per user before users got one per marketplace
+    cursor = connection.cursor()
+    table = Account._meta.db_table
+    if table not in connection.introspection.table_names(cursor):
+        return []
+    column = Account._meta.get_field('user').column
+    constraints = connection.introspection.get_constraints(cursor, table)
+    return [name for name, constraint in constraints.items()
+            if constraint['unique'] and constraint['columns'] == [column]]
+
+
+def _key_accounts_by_marketplace(editor, constraints):
+    # drop the constraint alone, altering the field would recreate its
+    # foreign key too
+    qn = connection.ops.quote_name
+    for name in constraints:
+        editor.execute(editor.sql_delete_unique % {
+            'table': qn(Account._meta.db_table), 'name': qn(name)})
+    editor.alter_unique_together(Account, (), Account._meta.unique_together)
+
+
+def _add_column_sql(model, field):
+    # without the schema editor
+    qn = connection.ops.quote_name
+    sql = 'ALTER TABLE %s ADD COLUMN %s %s' % (
+        qn(model._meta.db_table), qn(field.column), field.db_type(connection))
+    if not field.null:
+        default = field.get_default()
+        if isinstance(default, basestring):
+            default = "'%s'" % default.replace("'", "''")
+        elif isinstance(default, int) and not isinstance(default, bool):
+            default = '%d' % default
+        else:
+            raise CommandError('Cannot add %s.%s without a text or integer '
+                               'default' % (model.__name__, field.name))
+        sql += ' DEFAULT %s NOT NULL' % default
+    statements = [sql]
+    if field.db_index:
+        statements.extend(connection.creation.sql_indexes_for_field(
+            model, field, no_style()))
+    return statements
+
+
+def _execute(statements):
+    cursor = connection.cursor()
+    with _atomic():
+        for sql in statements:
+            cursor.execute(sql)
+        if not hasattr(transaction, 'atomic'):
+            # django < 1.6 only commits transactions it knows were written to
+            transaction.set_dirty()
+
+
+def _debit_cents_sql():
+    # debits kept the amount in cents, as Balanced sends it, until they
+    # were converted to decimal amounts like credits
+    qn = connection.ops.quote_name
+    field = Debit._meta.get_field('amount')
+    return 'UPDATE %s SET %s = %s / 100.0' % (
+        qn(Debit._meta.db_table), qn(field.column), qn(field.column))
+
+
+class Command(BaseCommand):
+    help = 'Adds the columns newer versions of django_balanced store, such ' \
+           'as the marketplace of each row, to tables syncdb created ' \
+           'before, and keys accounts by user and marketplace. Existing ' \
+           'rows belong to the default marketplace'
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run',
+                    dest='dry_run',
+                    action='store_true',
+                    default=False,
+                    help='Only print the SQL'),
+        make_option('--debits-in-cents',
+                    dest='debits_in_cents',
+                    action='store_true',
+                    default=False,
+                    help='Also convert the amounts of debits stored in '
+                         'cents by earlier versions to dollars. Run it '
+                         'only once'),
+    )
+
+    def handle(self, *args, **options):
+        if options['debits_in_cents']:
+            sql = _debit_cents_sql()
+            self.stdout.write('%s;\n' % sql)
+            if not options['dry_run']:
+                _execute([sql])
+                self.stdout.write('Converted the debit amounts\n')
+        missing = _missing_columns()
+        # django < 1.7 has no schema editor. sqlite's rebuilds tables from
+        # a copy of the model, which clashes with its abstract base, and
+        # cannot drop constraints without one
+        editable = hasattr(connection, 'schema_editor') and \
+            connection.vendor != 'sqlite'
+        single_accounts = editable and _single_account_constraints()
+        if not missing and not single_accounts:
+            self.stdout.write('The balanced tables are up to date\n')
+            return
+        if editable:
+            with connection.schema_editor(
+                    collect_sql=options['dry_run']) as editor:
+                for model, field in missing:
+                    editor.add_field(model, field)
+                if single_accounts:
+                    _key_accounts_by_marketplace(editor, single_accounts)
+            statements = editor.collected_sql
+        else:
+            statements = []
+            for model, field in missing:
+                statements.extend(_add_column_sql(model, field))
+            if not options['dry_run']:
+                _execute(statements)
+        for sql in statements:
+            self.stdout.write('%s;\n' % sql.rstrip(';'))
+        for model, field in missing:
+            self.stdout.write('%s %s.%s\n' % (
+                'Missing' if options['dry_run'] else 'Added',
+                model._meta.db_table, field.column))
+        if single_accounts:
+            self.stdout.write('%s accounts by user and marketplace\n' % (
+                'Not keying' if options['dry_run'] else 'Keyed'))
+        elif not editable and any(model is Account for model, _ in missing):
+            self.stdout.write(
+                'Replace the unique constraint on %s.user_id by one on '
+                '(user_id, marketplace) by hand, for users to get an '
+                'account per marketplace\n' % Account._meta.db_table)
@@ -0,0 +1,35 @@
+from __future__ import unicode_literals
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand
+
+from django_balanced.events import drain_events
+
+
+class Command(BaseCommand):
+    help = 'Applies the events received from Balanced callbacks to your ' \
+           'local system'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+                    dest='batch_size',
+                    type='int',
+                    default=None,
+                    help='Number of events applied per transaction'),
+        make_option('--poll',
+                    dest='poll',
+                    type='float',
+                    default=None,
+                    help='Keep running, checking for new events every POLL '
+                         'seconds'),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            drained = drain_events(options['batch_size'])
+            if drained:
+                self.stdout.write('%d events applied\n' % drained)
+            elif options['poll'] is None:
+                return
+            else:
+                time.sleep(options['poll'])
@@ -0,0 +1,21 @@
+from __future__ import unicode_literals
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from django_balanced.provisioning import backfill
+
+
+class Command(BaseCommand):
+    help = 'Creates a Balanced account for every user lacking one'
+    option_list = BaseCommand.option_list + (
+        make_option('--workers',
+                    dest='workers',
+                    type='int',
+                    default=4,
+                    help='Number of accounts created concurrently'),
+    )
+
+    def handle(self, *args, **options):
+        created = backfill(workers=options['workers'])
+        self.stdout.write('%d accounts created\n' % created)
@@ -0,0 +1,19 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_balanced.models import PaymentSummary
+
+
+class Command(BaseCommand):
+    args = '[user_id ...]'
+    help = 'Recomputes the per user payment summaries from the credits and ' \
+           'debits tables, for the given users or everyone'
+
+    def handle(self, *args, **options):
+        try:
+            users = [int(user_id) for user_id in args] or None
+        except ValueError as ex:
+            raise CommandError(ex)
+        rebuilt = PaymentSummary.rebuild(users)
+        self.stdout.write('%d payment summaries rebuilt\n' % rebuilt)
@@ -0,0 +1,78 @@
+from __future__ import unicode_literals
+from datetime import timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from django_balanced import tenants
+from django_balanced.management.utils import get_tenant, parse_date
+from django_balanced.models import Credit, Debit
+from django_balanced.reconcile import Reconciliation
+
+
+MODELS = {'credit': Credit, 'debit': Debit}
+
+
+class Command(BaseCommand):
+    args = '[credit|debit ...]'
+    help = 'Compares the local credits and debits with Balanced and reports ' \
+           'missing, extra and diverged records'
+    option_list = BaseCommand.option_list + (
+        make_option('--since',
+                    dest='since',
+                    default=None,
+                    help='First day to check, YYYY-MM-DD (default: 30 days '
+                         'ago)'),
+        make_option('--until',
+                    dest='until',
+                    default=None,
+                    help='Day to stop before, YYYY-MM-DD (default: now)'),
+        make_option('--bucket-hours',
+                    dest='bucket_hours',
+                    type='int',
+                    default=24,
+                    help='Hours per bucket compared, the smallest range '
+                         'fetched from Balanced'),
+        make_option('--fix',
+                    action='store_true',
+                    dest='fix',
+                    default=False,
+                    help='Write missing and diverged records from Balanced'),
+        make_option('--marketplace',
+                    dest='marketplace',
+                    default=None,
+                    help='Name of the marketplace in BALANCED MARKETPLACES '
+                         'to check, instead of the API_KEY one'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            models = [MODELS[name.lower()] for name in args or sorted(MODELS)]
+        except KeyError as ex:
+            raise CommandError('Unknown model %s' % ex)
+        until = parse_date(options['until']) if options['until'] else \
+            timezone.now()
+        since = parse_date(options['since']) if options['since'] else \
+            until - timedelta(days=30)
+        tenant = get_tenant(options['marketplace'])
+        for model in models:
+            with tenants.activate(tenant):
+                result = Reconciliation(
+                    model, since, until,
+                    bucket=timedelta(hours=options['bucket_hours']),
+                    fix=options['fix'],
+                ).run()
+            self.stdout.write(
+                '%s: %d buckets, %d fetched, %d requests: %d missing, '
+                '%d extra, %d diverged\n' % (
+                    model.__name__, result.buckets, result.fetched,
+                    result.round_trips, len(result.missing),
+                    len(result.extra), len(result.diverged)))
+            for uri in result.missing:
+                self.stdout.write('  missing %s\n' % uri)
+            for uri in result.extra:
+                self.stdout.write('  extra %s\n' % uri)
+            for uri, field, local, remote in result.diverged:
+                self.stdout.write('  diverged %s %s: %s locally, %s on '
+                                  'Balanced\n' % (uri, field, local, remote))
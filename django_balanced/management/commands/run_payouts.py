@@ -0,0 +1,30 @@
+from __future__ import unicode_literals
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from django_balanced.models import PayoutBatch
+from django_balanced.payouts import run_batch
+
+
+class Command(BaseCommand):
+    args = '[batch_id ...]'
+    help = 'Pays out unfinished bulk payout batches, e.g. after the ' \
+           'process running them was restarted'
+    option_list = BaseCommand.option_list + (
+        make_option('--workers',
+                    dest='workers',
+                    type='int',
+                    default=None,
+                    help='Number of credits sent concurrently'),
+    )
+
+    def handle(self, *args, **options):
+        batches = PayoutBatch.objects.exclude(status=PayoutBatch.DONE)
+        if args:
+            batches = batches.filter(pk__in=args)
+        for batch in batches:
+            run_batch(batch, workers=options['workers'], recover=True)
+            progress = batch.progress()
+            self.stdout.write('%s: %d paid, %d failed\n' % (
+                batch, progress['paid'], progress['failed']))
@@ -1,17 +1,49 @@
 from __future__ import unicode_literals
+from optparse import make_option
 
-import balanced
-from django.conf import settings
 from django.core.management.base import BaseCommand
 
-from django_balanced.models import BankAccount, Credit
+from django_balanced import tenants
+from django_balanced.management.utils import get_tenant
+from django_balanced.sync import sync_all
 
 
 class Command(BaseCommand):
-    help = 'Synchronizes your Balanced credits and bank accounts with your ' \
-           'local system'
+    help = 'Synchronizes your Balanced accounts, cards, bank accounts, ' \
+           'credits and debits with your local system'
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size',
+                    dest='chunk_size',
+                    type='int',
+                    default=None,
+                    help='Number of resources written per transaction'),
+        make_option('--full',
+                    action='store_true',
+                    dest='full',
+                    default=False,
+                    help='Ignore the stored watermarks and rescan every '
+                         'resource'),
+        make_option('--workers',
+                    dest='workers',
+                    type='int',
+                    default=1,
+                    help='Number of threads fetching and writing pages '
+                         'concurrently'),
+        make_option('--marketplace',
+                    dest='marketplace',
+                    default=None,
+                    help='Name of the marketplace in BALANCED MARKETPLACES '
+                         'to sync, instead of the API_KEY one'),
+    )
 
     def handle(self, *args, **options):
-        balanced.configure(settings.BALANCED['API_KEY'])
-        BankAccount.sync()
-        Credit.sync()
+        tenant = get_tenant(options['marketplace'])
+        with tenants.activate(tenant):
+            results = sync_all(workers=options['workers'],
+                               chunk_size=options['chunk_size'],
+                               incremental=not options['full'])
+        for model, stats in results:
+            self.stdout.write(
+                '%s: %d inserted, %d updated, %d skipped, %d unresolved\n' % (
+                    model.__name__, stats['inserted'], stats['updated'],
+                    stats['skipped'], stats['unresolved']))
@@ -0,0 +1,32 @@
+from __future__ import unicode_literals
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.utils import timezone
+
+from django_balanced import tenants
+
+
+def parse_date(value):
+    """
+    The start of the YYYY-MM-DD day `value`, in UTC when USE_TZ is on.
+    """
+    try:
+        date = datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise CommandError('%s is not a YYYY-MM-DD date' % value)
+    if settings.USE_TZ:
+        date = timezone.make_aware(date, timezone.utc)
+    return date
+
+
+def get_tenant(name):
+    """
+    The tenant of the marketplace `name` in BALANCED['MARKETPLACES'], the
+    API_KEY one when `name` is empty.
+    """
+    try:
+        return tenants.get(name or tenants.DEFAULT)
+    except tenants.UnknownTenant as ex:
+        raise CommandError('Unknown marketplace %s' % ex)
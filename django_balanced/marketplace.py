@@ -0,0 +1,57 @@
+from __future__ import unicode_literals
+
+import balanced
+from balanced.resources import Page
+
+from django_balanced import tenants
+
+
+# marketplace uris per api key, these never change for the life of a process
+_marketplace_uris = {}
+
+
+def _api_key():
+    return tenants.current().api_key or balanced.config.api_key_secret
+
+
+def get_marketplace_uri():
+    """
+    The uri of the current tenant's marketplace.
+    """
+    key = _api_key()
+    uri = _marketplace_uris.get(key)
+    if uri is None:
+        # not Marketplace.my_marketplace, which balanced caches under the
+        # global api key whatever key the request went out with
+        uri = balanced.Marketplace.query.one().uri
+        _marketplace_uris[key] = uri
+    return uri
+
+
+def resource_collection_uri(resource_cls):
+    """
+    The uri new resources of `resource_cls` are created at and queried
+    from, in the current tenant's marketplace where they live under one.
+    """
+    collection = resource_cls.RESOURCE['collection']
+    if not resource_cls.RESOURCE['resides_under_marketplace']:
+        return collection
+    return '%s/%s' % (get_marketplace_uri(), collection)
+
+
+def resource_query(resource_cls):
+    """
+    A query over the resources of `resource_cls` in the current tenant's
+    marketplace, for use instead of `resource_cls.query`.
+    """
+    uri = resource_collection_uri(resource_cls)
+    return Page.from_uri_and_params(uri, None)
+
+
+def refresh_escrow():
+    """
+    The marketplace's escrow balance in cents, as Balanced reports it now.
+    `django_balanced.escrow` keeps the balance payouts are admitted against.
+    """
+    marketplace = balanced.Marketplace.find(get_marketplace_uri())
+    return marketplace.in_escrow
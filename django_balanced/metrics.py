@@ -0,0 +1,168 @@
+from __future__ import unicode_literals
+from collections import defaultdict
+from contextlib import contextmanager
+from importlib import import_module
+import logging
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.dispatch import Signal
+
+
+LOGGER = logging.getLogger(__name__)
+
+# sent for every timing (kind='timing', value in ms) and count (kind='count')
+# with the `name` and `value` as arguments
+metric_recorded = Signal()
+# sent by BalancedMiddleware when a request finished, with the `request`
+# and the number of `round_trips` made to Balanced while serving it
+round_trips_recorded = Signal()
+
+_local = threading.local()
+
+
+class InMemoryMetrics(object):
+    """
+    Keeps counts and total milliseconds per metric, e.g. for tests and
+    benchmarks.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = defaultdict(int)
+        self.timings = defaultdict(float)
+
+    def timing(self, name, ms):
+        with self.lock:
+            self.timings[name] += ms
+
+    def incr(self, name, count=1):
+        with self.lock:
+            self.counts[name] += count
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+            self.timings.clear()
+
+
+class LoggingMetrics(object):
+
+    def __init__(self, logger=__name__, level=logging.INFO):
+        self.logger = logging.getLogger(logger)
+        self.level = level
+
+    def timing(self, name, ms):
+        self.logger.log(self.level, '%s took %.1fms', name, ms)
+
+    def incr(self, name, count=1):
+        self.logger.log(self.level, '%s +%d', name, count)
+
+
+class StatsdMetrics(object):
+    """
+    Sends metrics over UDP in the StatsD line format.
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='balanced'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, line):
+        try:
+            self.socket.sendto(line.encode('utf-8'), self.address)
+        except socket.error:
+            pass
+
+    def timing(self, name, ms):
+        self._send('%s.%s:%d|ms' % (self.prefix, name, ms))
+
+    def incr(self, name, count=1):
+        self._send('%s.%s:%d|c' % (self.prefix, name, count))
+
+
+_lock = threading.Lock()
+_backend = None
+
+
+def get_backend():
+    """
+    The backend named by `BALANCED['METRICS_BACKEND']`, instantiated with
+    `BALANCED['METRICS_OPTIONS']`, or None.
+    """
+    global _backend
+    path = settings.BALANCED['METRICS_BACKEND']
+    if path and _backend is None:
+        with _lock:
+            if _backend is None:
+                module, _, name = path.rpartition('.')
+                backend_cls = getattr(import_module(module), name)
+                _backend = backend_cls(**settings.BALANCED['METRICS_OPTIONS'])
+    return _backend
+
+
+def timing(name, ms):
+    backend = get_backend()
+    if backend is not None:
+        backend.timing(name, ms)
+    metric_recorded.send(sender=None, name=name, kind='timing', value=ms)
+
+
+def incr(name, count=1):
+    backend = get_backend()
+    if backend is not None:
+        backend.incr(name, count)
+    metric_recorded.send(sender=None, name=name, kind='count', value=count)
+
+
+@contextmanager
+def timed(name):
+    """
+    Records how long the block took, and that it ran, as `name`.
+    """
+    started = time.time()
+    try:
+        yield
+    finally:
+        timing(name, (time.time() - started) * 1000)
+        incr(name)
+
+
+def current_operation():
+    return getattr(_local, 'operation', None)
+
+
+@contextmanager
+def operation(name):
+    """
+    Labels the remote calls this thread makes within the block, they are
+    recorded as `remote.<name>`.
+    """
+    outer = current_operation()
+    _local.operation = name
+    try:
+        yield
+    finally:
+        _local.operation = outer
+
+
+def record_round_trip(method, ms):
+    # called by the transport for every http request sent to balanced
+    _local.round_trips = getattr(_local, 'round_trips', 0) + 1
+    name = 'remote.%s' % (current_operation() or method.lower())
+    timing(name, ms)
+    incr(name)
+
+
+def round_trips():
+    """
+    Requests this thread sent to Balanced since `reset_round_trips`.
+    """
+    return getattr(_local, 'round_trips', 0)
+
+
+def reset_round_trips():
+    _local.round_trips = 0
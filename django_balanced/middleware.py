@@ -1,10 +1,35 @@
 from __future__ import unicode_literals
 
-import balanced
 from django.conf import settings
 
+from django_balanced import cache, metrics, tenants
+
 
 class BalancedMiddleware(object):
 
-    def process_request(*_):
-        balanced.configure(settings.BALANCED['API_KEY'])
+    def process_request(self, request):
+        # the request talks to balanced as the tenant the resolver picks
+        request._balanced_tenant = tenants.activate(tenants.resolve(request))
+        request._balanced_tenant.__enter__()
+        metrics.reset_round_trips()
+        # remote resources are looked up at most once per request
+        request._balanced_scope = cache.resource_scope()
+        request._balanced_scope.__enter__()
+
+    def process_response(self, request, response):
+        scope = getattr(request, '_balanced_scope', None)
+        if scope is not None:
+            del request._balanced_scope
+            scope.__exit__(None, None, None)
+        tenant = getattr(request, '_balanced_tenant', None)
+        if tenant is not None:
+            del request._balanced_tenant
+            tenant.__exit__(None, None, None)
+        # lets tests and monitoring catch views making N+1 remote calls
+        round_trips = metrics.round_trips()
+        metrics.incr('request.round_trips', round_trips)
+        metrics.round_trips_recorded.send(
+            sender=self.__class__, request=request, round_trips=round_trips)
+        if settings.DEBUG:
+            response['X-Balanced-Round-Trips'] = str(round_trips)
+        return response
@@ -1,24 +1,371 @@
 from __future__ import unicode_literals
 from datetime import datetime
+from decimal import Decimal
+import hashlib
+from itertools import islice
+import json
+from multiprocessing.pool import ThreadPool
+import threading
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+try:
+    basestring
+except NameError:  # python 3
+    basestring = str
+    long = int
 
 import balanced
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import IntegrityError, connections, models, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from django_balanced import cache, metrics, tenants, throttle
+from django_balanced.marketplace import resource_collection_uri, resource_query
 
 
 class BalancedException(Exception):
     pass
 
 
+def _atomic(using=None):
+    # transaction.atomic only exists from django 1.6 onwards
+    atomic = getattr(transaction, 'atomic', None)
+    if atomic is None:
+        atomic = transaction.commit_on_success
+    return atomic(using=using)
+
+
+def _chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _prefetch(iterable, depth):
+    """
+    Iterates `iterable` in a background thread, keeping at most `depth`
+    items buffered ahead of the consumer. Errors raised while producing are
+    re-raised in the consumer.
+    """
+    if depth < 1:
+        for item in iterable:
+            yield item
+        return
+    buffered = queue.Queue(depth)
+    stopped = threading.Event()
+    done = object()
+    lane = throttle.current_lane()
+    tenant = tenants.current()
+
+    def put(item):
+        # don't block forever on a consumer that went away
+        while not stopped.is_set():
+            try:
+                buffered.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            with throttle.lane(lane), tenants.activate(tenant):
+                for item in iterable:
+                    if not put((item, None)):
+                        return
+        except Exception as ex:
+            put((done, ex))
+        else:
+            put((done, None))
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item, error = buffered.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+
+
+def _labelled(iterable, operation):
+    # label the remote calls made while advancing a lazily fetched query
+    iterator = iter(iterable)
+    while True:
+        with metrics.operation(operation):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def _bulk_update(model, instances, fields):
+    """
+    Writes `fields` of `instances` with as few UPDATE statements as the
+    database's limit on query parameters allows, setting every column with
+    a CASE over the primary keys.
+    """
+    manager = model._default_manager
+    if hasattr(manager, 'bulk_update'):
+        manager.bulk_update(instances, [f.name for f in fields])
+        return
+    connection = connections[manager.db]
+    # every row takes its primary key once per field and once more for
+    # the WHERE clause
+    per_row = [None] * (2 * len(fields) + 1)
+    batch_size = connection.ops.bulk_batch_size(per_row, instances) \
+        if hasattr(connection.ops, 'bulk_batch_size') else len(instances)
+    for batch in _chunked(instances, max(batch_size, 1)):
+        _update_rows(connection, model, batch, fields)
+
+
+def _update_rows(connection, model, instances, fields):
+    qn = connection.ops.quote_name
+    pk = model._meta.pk
+    pks = [pk.get_db_prep_value(i.pk, connection) for i in instances]
+    columns, params = [], []
+    for field in fields:
+        then = '%s'
+        if connection.vendor == 'postgresql':
+            # the CASE would be typed after its branches, text literals
+            then = 'CAST(%%s AS %s)' % field.db_type(connection)
+        columns.append('%s = CASE %s %s END' % (
+            qn(field.column), qn(pk.column),
+            ' '.join(['WHEN %%s THEN %s' % then] * len(instances))))
+        for key, instance in zip(pks, instances):
+            params.append(key)
+            params.append(field.get_db_prep_save(
+                getattr(instance, field.attname), connection))
+    connection.cursor().execute('UPDATE %s SET %s WHERE %s IN (%s)' % (
+        qn(model._meta.db_table), ', '.join(columns), qn(pk.column),
+        ', '.join(['%s'] * len(pks))), params + pks)
+    if not hasattr(transaction, 'atomic'):
+        # django < 1.6 only commits transactions it knows were written to
+        transaction.commit_unless_managed(using=connection.alias)
+
+
+def _remote_uri(obj, name):
+    # read the uri of a related resource without following the lazy
+    # descriptor the client installs for `<name>_uri`, which would fetch it
+    value = obj.__dict__.get(name)
+    if value is not None:
+        return getattr(value, 'uri', None)
+    return obj.__dict__.get(name + '_uri')
+
+
+def _resolve_users(instances):
+    # fill in the user of synced rows from the balanced account they
+    # belong to, which must already have been synced
+    account_uris = set(getattr(i, '_account_uri', None) for i, _ in instances)
+    # chunks are synced as the tenant of the marketplace they came from
+    users = dict(Account.objects.for_marketplace().filter(
+        uri__in=account_uris - set([None]),
+    ).values_list('uri', 'user_id'))
+    for instance, _ in instances:
+        if instance.user_id is None:
+            instance.user_id = users.get(
+                getattr(instance, '_account_uri', None))
+
+
+def _cents(amount):
+    # amounts come back from the database as decimals, or as floats from
+    # sqlite aggregates, which int() would truncate a cent short
+    return int((Decimal(str(amount or 0)) * 100).quantize(Decimal('1')))
+
+
+_MISSING = object()
+
+
+def _value_getter(key, types=(basestring, int, datetime)):
+    def get(obj):
+        value = obj.__dict__.get(key)
+        return value if isinstance(value, types) else _MISSING
+    return get
+
+
+def _local_datetime(value):
+    # balanced reports utc, store it the way the project expects. None for
+    # anything that is not a datetime
+    if isinstance(value, basestring):
+        value = parse_datetime(value)
+    if not isinstance(value, datetime):
+        return None
+    if settings.USE_TZ and timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.utc)
+    elif not settings.USE_TZ and timezone.is_aware(value):
+        value = timezone.make_naive(value, timezone.utc)
+    return value
+
+
+def _datetime_getter(key):
+    def get(obj):
+        value = _local_datetime(obj.__dict__.get(key))
+        return _MISSING if value is None else value
+    return get
+
+
+def _cents_getter(key):
+    def get(obj):
+        value = obj.__dict__.get(key)
+        if isinstance(value, (int, long)) and not isinstance(value, bool):
+            return Decimal(value) / 100
+        return _MISSING
+    return get
+
+
+def _uri_getter(key):
+    def get(obj):
+        return _remote_uri(obj, key) or _MISSING
+    return get
+
+
+def _fingerprint(obj):
+    """
+    A digest of the remote attributes of `obj`. Embedded resources count by
+    their uri, so a payload hashes the same whether it came from a query, a
+    find or a callback.
+    """
+    values = {}
+    for key, value in obj.__dict__.items():
+        if key.startswith('_'):
+            continue
+        if value is not None and not isinstance(
+                value, (basestring, int, long, float, dict, list, datetime)):
+            key, value = key + '_uri', getattr(value, 'uri', None)
+        values[key] = value
+    payload = json.dumps(values, sort_keys=True, default='{0}'.format)
+    return hashlib.md5(payload.encode('utf-8')).hexdigest()
+
+
+class _SyncState(tuple):
+    # naive and aware datetimes refuse to compare on python 2, treat that
+    # as a change rather than blowing up the sync
+    def __ne__(self, other):
+        try:
+            return tuple.__ne__(self, other)
+        except TypeError:
+            return True
+
+
+def _find_remote(args):
+    # runs in a pool thread, which must not touch the database
+    resource_cls, uri, lane, tenant = args
+    with throttle.lane(lane), tenants.activate(tenant):
+        with metrics.operation('find'):
+            try:
+                return resource_cls.find(uri)
+            except balanced.exc.HTTPError as ex:
+                if getattr(ex, 'status_code', None) == 404:
+                    return None
+                raise
+
+
+class BalancedQuerySet(models.query.QuerySet):
+
+    def refresh_from_balanced(self, workers=None, chunk_size=None):
+        """
+        Fetches the live remote state of every row, with up to `workers`
+        concurrent finds (defaults to `BALANCED['REFRESH_WORKERS']`), and
+        writes back the rows that changed with one bulk update per
+        `chunk_size` rows (defaults to `BALANCED['SYNC_CHUNK_SIZE']`).
+
+        Rows are fetched as the tenant of the marketplace they belong to.
+        Returns the counts of `BalancedResource.sync`, plus the rows that
+        no longer exist on Balanced as `missing`.
+        """
+        model = self.model
+        workers = workers or settings.BALANCED['REFRESH_WORKERS']
+        chunk_size = chunk_size or settings.BALANCED['SYNC_CHUNK_SIZE']
+        stats = dict.fromkeys(
+            ('inserted', 'updated', 'skipped', 'unresolved', 'missing'), 0)
+        uris = {}
+        for uri, marketplace in self.values_list('pk', 'marketplace'):
+            uris.setdefault(marketplace, []).append(uri)
+        lane = throttle.current_lane()
+        pool = None
+        total = sum(len(u) for u in uris.values())
+        if workers > 1 and total > 1:
+            pool = ThreadPool(min(workers, total))
+        try:
+            for marketplace in sorted(uris):
+                with tenants.activate(marketplace) as tenant:
+                    for chunk in _chunked(uris[marketplace], chunk_size):
+                        args = [(model._resource, uri, lane, tenant)
+                                for uri in chunk]
+                        if pool is not None:
+                            resources = pool.map(_find_remote, args)
+                        else:
+                            resources = [_find_remote(a) for a in args]
+                        resources = [r for r in resources if r is not None]
+                        stats['missing'] += len(chunk) - len(resources)
+                        for resource in resources:
+                            cache.store(resource)
+                        if resources:
+                            for key, count in model._sync_chunk(
+                                    resources).items():
+                                stats[key] += count
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return stats
+
+    def for_marketplace(self, name=None):
+        """
+        The rows of the marketplace `name`, the current tenant's by default.
+        """
+        return self.filter(marketplace=name or tenants.current().name)
+
+
+class BalancedManager(models.Manager):
+
+    def get_queryset(self):
+        return BalancedQuerySet(self.model, using=self._db)
+    # django < 1.6
+    get_query_set = get_queryset
+
+    def refresh_from_balanced(self, *args, **kwargs):
+        # all() goes through the related managers' filtering too
+        return self.all().refresh_from_balanced(*args, **kwargs)
+
+    def for_marketplace(self, *args, **kwargs):
+        return self.all().for_marketplace(*args, **kwargs)
+
+
 class BalancedResource(models.Model):
     _resource = balanced.Resource
+    # remote attribute names of fields, where they differ
+    _remote_names = {}
+    # fields balanced reports in cents, stored locally as decimals
+    _cents_fields = ()
     id = models.CharField(max_length=255, editable=False)
     uri = models.CharField(primary_key=True, max_length=255, editable=False)
-    created_at = models.DateTimeField(auto_created=True, editable=False)
+    created_at = models.DateTimeField(auto_created=True, editable=False,
+                                      db_index=True)
+    # digest of the remote payload the row was last written from
+    fingerprint = models.CharField(max_length=32, null=True, editable=False)
+    # the tenant the row was read from, see django_balanced.tenants
+    marketplace = models.CharField(max_length=64, default=tenants.DEFAULT,
+                                   editable=False, db_index=True)
+
+    objects = BalancedManager()
 
     class Meta:
         abstract = True
@@ -30,25 +377,252 @@ class BalancedResource(models.Model):
         )
     dashboard_link.allow_tags = True
 
-    def find(self):
-        return self._resource.find(self.uri)
+    def find(self, fresh=False):
+        return cache.find(self._resource, self.uri, fresh)
+
+    def proxy(self, **attributes):
+        """
+        A remote resource standing in for this row without fetching it, for
+        writes that only need its uri. Saving it PUTs `attributes`.
+        """
+        return self._resource(uri=self.uri, id=self.id, **attributes)
+
+    def collection_uri(self, collection):
+        # nested collections live right under the resource, e.g.
+        # /v1/bank_accounts/BA123/credits
+        return '%s/%s' % (self.uri, collection)
 
     @classmethod
-    def sync(cls):
-        for resource in cls._resource.query:
-            try:
-                existing = cls.objects.get(uri=resource.uri)
-            except cls.DoesNotExist:
-                existing = cls()
-            existing._sync(resource)
-            existing.save()
+    def sync(cls, chunk_size=None, incremental=False):
+        """
+        Upserts every remote resource of this type into the local table.
+
+        Resources are read oldest first and written in chunks of
+        `chunk_size` (defaults to `BALANCED['SYNC_CHUNK_SIZE']`), each inside
+        its own transaction, while up to `BALANCED['SYNC_PREFETCH']` further
+        chunks are fetched in the background. After every chunk the newest
+        `created_at` seen is checkpointed in `SyncWatermark`; with
+        `incremental` only resources created since that watermark are
+        requested, so an interrupted run resumes where it stopped. The
+        watermark stops before the first resource left out, so the next
+        incremental sync retries it. Rows whose stored fingerprint matches
+        the remote payload are skipped.
 
-    def _sync(self, obj):
-        for field in self._meta.get_all_field_names():
-            has = hasattr(obj, field)
-            value = has and getattr(obj, field)
-            if has and isinstance(value, (basestring, int, datetime)):
-                setattr(self, field, value)
+        Returns a dict counting the rows inserted, updated, skipped as
+        unchanged and left out because a related row could not be resolved.
+        """
+        chunk_size = chunk_size or settings.BALANCED['SYNC_CHUNK_SIZE']
+        watermark, _ = SyncWatermark.objects.get_or_create(
+            resource=tenants.current().qualify(cls.__name__))
+        since = watermark.created_at if incremental else None
+        stats = dict.fromkeys(
+            ('inserted', 'updated', 'skipped', 'unresolved'), 0)
+        with throttle.lane(throttle.BACKGROUND):
+            # the next chunk is fetched while the current one is written
+            query = _labelled(cls._sync_query(since), 'query')
+            chunks = _prefetch(_chunked(query, chunk_size),
+                               settings.BALANCED['SYNC_PREFETCH'])
+            for chunk in chunks:
+                for key, count in cls._sync_chunk(chunk, watermark).items():
+                    stats[key] += count
+        return stats
+
+    @classmethod
+    def _query(cls):
+        # not _resource.query, which is in the marketplace of the global
+        # api key rather than the current tenant's
+        return resource_query(cls._resource)
+
+    @classmethod
+    def _sync_query(cls, since=None):
+        # resources sharing the watermark's timestamp are read again, the
+        # upsert makes that harmless
+        query = cls._query()
+        if since is not None:
+            query = query.filter(
+                cls._resource.f.created_at >= since.isoformat())
+        return query.sort(cls._resource.f.created_at.asc())
+
+    @classmethod
+    def _sync_chunk(cls, resources, watermark=None, force=False):
+        # the save() overrides all talk to balanced again, so rows are
+        # written with bulk_create/bulk_update instead. `force` compares
+        # rows changed locally behind the fingerprint's back as well
+        fields = [f for f in cls._meta.fields if not f.primary_key]
+        required = [f for f in fields
+                    if isinstance(f, models.ForeignKey) and not f.null]
+        optional = [f.attname for f in fields
+                    if isinstance(f, models.ForeignKey) and f.null]
+        stats = dict.fromkeys(
+            ('inserted', 'updated', 'skipped', 'unresolved'), 0)
+        with _atomic():
+            with metrics.timed('sync.lookup'):
+                # rows still missing a relation, e.g. the user of a bank
+                # account synced before its account, are completed again
+                fingerprints = dict(
+                    (row[0], None if None in row[2:] else row[1])
+                    for row in cls.objects.filter(
+                        uri__in=[r.uri for r in resources],
+                    ).values_list('uri', 'fingerprint', *optional))
+            # rows whose payload did not change are neither loaded nor
+            # hydrated nor written
+            changed = []
+            with metrics.timed('sync.fingerprint'):
+                for resource in resources:
+                    fingerprint = _fingerprint(resource)
+                    if not force and fingerprints.get(
+                            resource.uri, _MISSING) == fingerprint:
+                        stats['skipped'] += 1
+                    else:
+                        changed.append((resource, fingerprint))
+            with metrics.timed('sync.lookup'):
+                existing = cls.objects.in_bulk(
+                    [r.uri for r, _ in changed if r.uri in fingerprints])
+            instances = []
+            with metrics.timed('sync.hydrate'):
+                for resource, fingerprint in changed:
+                    instance = existing.get(resource.uri) or cls()
+                    before = instance._sync_state()
+                    instance._sync(resource, fingerprint)
+                    instance._sync_related(resource)
+                    instances.append((instance, before))
+            with metrics.timed('sync.lookup'):
+                instances = cls._complete_chunk(instances)
+            to_create, to_update = [], []
+            unresolved = set(r.uri for r, _ in changed) - set(
+                i.uri for i, _ in instances)
+            for instance, before in instances:
+                if any(getattr(instance, f.attname) is None for f in required):
+                    unresolved.add(instance.uri)
+                elif instance.pk not in existing:
+                    to_create.append(instance)
+                elif instance._sync_state() != before:
+                    to_update.append((instance, before))
+                else:
+                    stats['skipped'] += 1
+            stats['unresolved'] = len(unresolved)
+            with metrics.timed('sync.write'):
+                if to_create:
+                    cls.objects.bulk_create(to_create)
+                if to_update:
+                    _bulk_update(cls, [i for i, _ in to_update], fields)
+                cls._rows_written([(i, None) for i in to_create] + to_update)
+                if watermark is not None:
+                    watermark.advance(resources, unresolved)
+        stats['inserted'] = len(to_create)
+        stats['updated'] = len(to_update)
+        return stats
+
+    @classmethod
+    def _rows_written(cls, rows):
+        """
+        Hook called in the transaction that bulk wrote `rows`, a list of
+        `(instance, previous_state)` pairs, `None` for inserted rows.
+        """
+
+    @classmethod
+    def _complete_chunk(cls, instances):
+        """
+        Hook to fill in fields that need a query, once per sync chunk.
+        Receives and returns a list of `(instance, previous_state)` pairs;
+        pairs left out are counted as unresolved.
+        """
+        return instances
+
+    def _sync_state(self):
+        return _SyncState(getattr(self, f.attname) for f in self._meta.fields)
+
+    @classmethod
+    def _sync_plan(cls):
+        """
+        The `(attname, getter)` pairs `_sync` copies from a remote resource,
+        worked out once per model. Foreign keys to other balanced resources
+        are read from the related resource's uri, named after
+        `_remote_names` when the remote attribute differs from the field.
+        """
+        plan = cls.__dict__.get('_compiled_sync_plan')
+        if plan is not None:
+            return plan
+        plan = []
+        for field in cls._meta.fields:
+            if field.name in ('fingerprint', 'marketplace'):
+                continue
+            key = cls._remote_names.get(field.name, field.name)
+            if field.rel:
+                if issubclass(field.rel.to, BalancedResource):
+                    plan.append((field.attname, _uri_getter(key)))
+            elif field.name in cls._cents_fields:
+                plan.append((field.attname, _cents_getter(key)))
+            elif isinstance(field, models.DateTimeField):
+                plan.append((field.attname, _datetime_getter(key)))
+            else:
+                plan.append((field.attname, _value_getter(key)))
+        cls._compiled_sync_plan = plan
+        return plan
+
+    def _sync(self, obj, fingerprint=None):
+        # values are read straight from the resource's __dict__, going
+        # through getattr would fetch lazily loaded related resources
+        for attname, get in self._sync_plan():
+            value = get(obj)
+            if value is not _MISSING:
+                setattr(self, attname, value)
+        self.fingerprint = fingerprint or _fingerprint(obj)
+        self.marketplace = tenants.current().name
+
+    def _sync_related(self, obj):
+        """
+        Hook to copy values `_sync` cannot take verbatim from `obj`, such as
+        foreign keys. Must not make any queries or remote calls.
+        """
+
+
+class SyncWatermark(models.Model):
+    """
+    The newest remote resource `BalancedResource.sync` has written for a
+    resource type and tenant, used to resume incremental syncs.
+    """
+    resource = models.CharField(primary_key=True, max_length=255)
+    created_at = models.DateTimeField(null=True)
+    uri = models.CharField(max_length=255, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'balanced_sync_watermarks'
+
+    def __unicode__(self):
+        return '%s @ %s' % (self.resource, self.created_at)
+
+    # set once a resource of this run could not be written
+    held = False
+
+    def advance(self, resources, unresolved=()):
+        """
+        Moves the watermark to the last of `resources`, a chunk in sync
+        order, or to the one before the first whose uri is `unresolved`.
+        It then stays there for the rest of the run, so the next
+        incremental sync fetches the resources left out again.
+        """
+        if self.held:
+            return
+        for index, resource in enumerate(resources):
+            if resource.uri in unresolved:
+                self.held = True
+                resources = resources[:index]
+                break
+        if resources:
+            self.created_at = _local_datetime(resources[-1].created_at)
+            self.uri = resources[-1].uri
+            self.save()
+
+
+class _ChunkProgress(object):
+    # how far a chunk written in a pool thread lets the watermark move,
+    # applied by the caller once every chunk before it is written
+
+    def advance(self, resources, unresolved=()):
+        self.resources = resources
+        self.unresolved = unresolved
 
 
 class BankAccount(BalancedResource):
@@ -81,32 +655,41 @@ class BankAccount(BalancedResource):
                 type=self.type,
             )
         else:
-            bank_account = self.find()
+            bank_account = self.find(fresh=True)
         try:
-            bank_account.save()
+            with metrics.operation('save'):
+                bank_account.save()
         except balanced.exc.HTTPError as ex:
             raise ex
+        cache.store(bank_account)
 
         self._sync(bank_account)
         super(BankAccount, self).save(**kw)
 
     def delete(self, using=None):
-        bank_account = self.find()
-        bank_account.delete()
+        bank_account = self.find(fresh=True)
+        with metrics.operation('delete'):
+            bank_account.delete()
+        cache.invalidate(self.uri)
         super(BankAccount, self).delete(using)
 
-    def credit(self, amount, description=None):
-        bank_account = self.find()
-        credit = bank_account.credit(amount, description)
+    def credit(self, amount, description=None, meta=None):
+        django_credit = Credit(
+            amount=amount,
+            description=description,
+            bank_account=self,
+            user=self.user,
+        )
+        django_credit.save(meta=meta)
+        return django_credit
 
-        django_credit = Credit()
-        django_credit._sync(credit)
-        django_credit.bank_account = self
-        django_credit.user = self.user
-        django_credit.amount /= 100.0
-        django_credit.save()
+    def _sync_related(self, obj):
+        self._account_uri = _remote_uri(obj, 'account')
 
-        return django_credit
+    @classmethod
+    def _complete_chunk(cls, instances):
+        _resolve_users(instances)
+        return instances
 
 
 class Card(BalancedResource):
@@ -135,31 +718,97 @@ class Card(BalancedResource):
         # a card must be saved elsewhere since we don't store the data required
         # to create a card from the django object
         if not self.uri:
-            account = self.user.balanced_account.find()
-            account.add_card(card_uri=card_uri)
+            account = Account.for_user(self.user).proxy(card_uri=card_uri)
+            with metrics.operation('save'):
+                account.save()
+            cache.store(account)
             self.uri = card_uri
-        card = self.find()
+        card = self.find(fresh=True)
         self._sync(card)
 
         super(Card, self).save(**kwargs)
 
     def delete(self, using=None):
-        card = self.find()
+        card = self.find(fresh=True)
         card.is_valid = False
-        card.save()
+        with metrics.operation('save'):
+            card.save()
+        cache.invalidate(self.uri)
         super(Card, self).delete(using)
 
     def debit(self, amount, description):
-        account = self.user.balanced_account
+        account = Account.for_user(self.user)
         return account.debit(
             amount=amount,
             description=description,
             card=self,
         )
 
+    def _sync_related(self, obj):
+        self._account_uri = _remote_uri(obj, 'account')
+
+    @classmethod
+    def _complete_chunk(cls, instances):
+        _resolve_users(instances)
+        return instances
+
+
+class _Payment(object):
+    """
+    Keeps `PaymentSummary` current for every credit or debit written, in the
+    same transaction.
+    """
+    _summary_kind = None
 
-class Credit(BalancedResource):
+    @classmethod
+    def _summary_values(cls, values):
+        # (user_id, status, cents, created_at) of a row's field values
+        if values.get('user_id') is None:
+            return None
+        return (values['user_id'], values.get('status') or '',
+                _cents(values.get('amount')),
+                values.get('created_at'))
+
+    def _field_values(self):
+        return dict((f.attname, getattr(self, f.attname))
+                    for f in self._meta.fields)
+
+    def _stored_summary_values(self):
+        if not self.pk:
+            return None
+        fields = [f for f in self._meta.fields
+                  if f.name in ('user', 'status', 'amount', 'created_at')]
+        rows = type(self).objects.filter(pk=self.pk).values_list(
+            *[f.name for f in fields])[:1]
+        if not rows:
+            return None
+        return self._summary_values(
+            dict(zip([f.attname for f in fields], rows[0])))
+
+    def _save_with_summary(self, save, **kwargs):
+        with _atomic():
+            previous = self._stored_summary_values()
+            save(**kwargs)
+            PaymentSummary.apply(self._summary_kind, [
+                (previous, self._summary_values(self._field_values()))])
+
+    @classmethod
+    def _rows_written(cls, rows):
+        attnames = [f.attname for f in cls._meta.fields]
+        changes = []
+        for instance, before in rows:
+            previous = None
+            if before is not None:
+                previous = cls._summary_values(dict(zip(attnames, before)))
+            changes.append(
+                (previous, cls._summary_values(instance._field_values())))
+        PaymentSummary.apply(cls._summary_kind, changes)
+
+
+class Credit(_Payment, BalancedResource):
     _resource = balanced.Credit
+    _cents_fields = ('amount',)
+    _summary_kind = 'credit'
 
     user = models.ForeignKey(User,
                              related_name='credits',
@@ -178,35 +827,55 @@ class Credit(BalancedResource):
 #        app_label = 'Balanced'
         db_table = 'balanced_credits'
 
-    def save(self, **kwargs):
+    def save(self, meta=None, **kwargs):
         if not self.uri:
-            bank_account = self.bank_account.find()
+            # amount is in cents until the credit is synced
             credit = self._resource(
-                uri=bank_account.credits_uri,
+                uri=self.bank_account.collection_uri('credits'),
                 amount=self.amount,
                 description=self.description,
+                meta=meta or {},
             )
             try:
-                credit.save()
+                with metrics.operation('credit'):
+                    credit.save()
             except balanced.exc.HTTPError as ex:
                 raise ex
+            cache.store(credit)
         else:
-            credit = self.find()
+            credit = self.find(fresh=True)
 
         self._sync(credit)
-        self.amount = credit.amount / 100.0
         if not self.bank_account_id:
             bank_account = BankAccount.objects.get(pk=credit.bank_account.uri)
             self.bank_account = bank_account
 
-        super(Credit, self).save(**kwargs)
+        self._save_with_summary(super(Credit, self).save, **kwargs)
 
     def delete(self, using=None):
         raise NotImplemented
 
+    @classmethod
+    def _complete_chunk(cls, instances):
+        owners = BankAccount.objects.filter(
+            uri__in=set(i.bank_account_id for i, _ in instances),
+        ).values_list('uri', 'user_id')
+        owners = dict(owners)
+        completed = []
+        for instance, before in instances:
+            if instance.bank_account_id not in owners:
+                continue
+            if instance.user_id is None:
+                instance.user_id = owners[instance.bank_account_id]
+            completed.append((instance, before))
+        return completed
+
 
-class Debit(BalancedResource):
+class Debit(_Payment, BalancedResource):
     _resource = balanced.Debit
+    _remote_names = {'card': 'source'}
+    _cents_fields = ('amount',)
+    _summary_kind = 'debit'
 
     user = models.ForeignKey(User,
                              related_name='debits',
@@ -225,47 +894,93 @@ class Debit(BalancedResource):
 
     def save(self, **kwargs):
         if not self.uri:
-            account = self.user.balanced_account.find()
             try:
                 self.card
             except ObjectDoesNotExist:
                 self.card = self.user.cards.all()[0]
-            debit = account.debit(
+            # amount is in cents until the debit is synced
+            debit = self._resource(
+                uri=Account.for_user(self.user).collection_uri('debits'),
                 amount=self.amount,
                 description=self.description,
                 source_uri=self.card.uri,
             )
             try:
-                debit.save()
+                with metrics.operation('debit'):
+                    debit.save()
             except balanced.exc.HTTPError as ex:
                 raise ex
+            cache.store(debit)
         else:
-            debit = self.find()
+            debit = self.find(fresh=True)
 
         self._sync(debit)
-        super(Debit, self).save(**kwargs)
+        self._save_with_summary(super(Debit, self).save, **kwargs)
 
     def delete(self, using=None):
         raise NotImplemented
 
+    def _sync_related(self, obj):
+        self._account_uri = _remote_uri(obj, 'account')
+
+    @classmethod
+    def _complete_chunk(cls, instances):
+        _resolve_users(instances)
+        cards = set(Card.objects.filter(
+            uri__in=set(i.card_id for i, _ in instances),
+        ).values_list('uri', flat=True))
+        return [(i, before) for i, before in instances if i.card_id in cards]
+
 
 class Account(BalancedResource):
     _resource = balanced.Account
 
-    user = models.OneToOneField(User, related_name='balanced_account')
+    # one per marketplace the user pays in
+    user = models.ForeignKey(User, related_name='balanced_accounts')
 
     class Meta:
         db_table = 'balanced_accounts'
+        unique_together = ('user', 'marketplace')
+
+    @classmethod
+    def for_user(cls, user):
+        """
+        The balanced account of `user` in the current tenant's marketplace,
+        created on Balanced the first time a payment needs one.
+        """
+        accounts = cls.objects.for_marketplace()
+        try:
+            return accounts.get(user=user)
+        except cls.DoesNotExist:
+            pass
+        try:
+            with _atomic():
+                # concurrent calls wait here for the account the first one
+                # creates, rather than each creating one on Balanced
+                User.objects.select_for_update().get(pk=user.pk)
+                try:
+                    return accounts.get(user=user)
+                except cls.DoesNotExist:
+                    pass
+                account = cls(user=user)
+                account.save()
+        except IntegrityError:
+            # databases without row locks, e.g. sqlite
+            account = accounts.get(user=user)
+        return account
 
     def save(self, **kwargs):
         if not self.uri:
-            ac = balanced.Account(
+            ac = self._resource(
+                uri=resource_collection_uri(self._resource),
                 name=self.user.username,
             )
             try:
-                ac.save()
+                with metrics.operation('save'):
+                    ac.save()
             except balanced.exc.HTTPError as ex:
                 raise ex
+            cache.store(ac)
             self._sync(ac)
 
         super(Account, self).save(**kwargs)
@@ -284,11 +999,282 @@ class Account(BalancedResource):
     def delete(self, using=None):
         raise NotImplemented
 
+    def _sync_related(self, obj):
+        # accounts are created with the username as their name
+        self._username = obj.__dict__.get('name')
+
+    @classmethod
+    def _complete_chunk(cls, instances):
+        users = dict(User.objects.filter(
+            username__in=set(i._username for i, _ in instances),
+        ).values_list('username', 'id'))
+        # a user only has one account per marketplace, leave those already
+        # linked alone
+        taken = set(cls.objects.for_marketplace().filter(
+            user__in=users.values(),
+        ).exclude(
+            uri__in=[i.uri for i, _ in instances],
+        ).values_list('user_id', flat=True))
+        for instance, _ in instances:
+            if instance.user_id is None:
+                user_id = users.get(instance._username)
+                if user_id not in taken:
+                    instance.user_id = user_id
+        return instances
+
+
+class EscrowLedger(models.Model):
+    """
+    The escrow balance of a marketplace as last read from Balanced, and how
+    much of it is held for payouts in flight, see `django_balanced.escrow`.
+    Amounts are in cents.
+    """
+    marketplace_uri = models.CharField(primary_key=True, max_length=255)
+    balance = models.BigIntegerField(default=0)
+    reserved = models.BigIntegerField(default=0)
+    refreshed_at = models.DateTimeField(null=True)
+
+    class Meta:
+        db_table = 'balanced_escrow_ledgers'
+
+    def __unicode__(self):
+        return '%s: %d available' % (self.marketplace_uri,
+                                     self.balance - self.reserved)
+
+
+class EscrowReservation(models.Model):
+    HELD = 'held'
+    SETTLED = 'settled'
+
+    ledger = models.ForeignKey(EscrowLedger, related_name='reservations')
+    amount = models.BigIntegerField()  # cents
+    spent = models.BigIntegerField(default=0)  # cents
+    status = models.CharField(max_length=16, default=HELD)
+    created_by = models.ForeignKey(User, null=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+    settled_at = models.DateTimeField(null=True)
+
+    class Meta:
+        db_table = 'balanced_escrow_reservations'
+
+    def __unicode__(self):
+        return 'Reservation of %d (%s)' % (self.amount, self.status)
+
+
+class PaymentSummary(models.Model):
+    """
+    Count and total in cents of a user's credits or debits per status, kept
+    current as they are written. Debits have no status, theirs is ''.
+    """
+    CREDIT = 'credit'
+    DEBIT = 'debit'
+
+    user = models.ForeignKey(User, related_name='payment_summaries')
+    kind = models.CharField(max_length=16)
+    status = models.CharField(max_length=255, blank=True)
+    count = models.IntegerField(default=0)
+    total = models.BigIntegerField(default=0)  # cents
+    last_activity = models.DateTimeField(null=True)
+
+    class Meta:
+        db_table = 'balanced_payment_summaries'
+        unique_together = ('user', 'kind', 'status')
+
+    def __unicode__(self):
+        return '%s %s %s: %d for %d' % (self.user_id, self.kind, self.status,
+                                        self.count, self.total)
+
+    @classmethod
+    def totals(cls, user):
+        """
+        `{kind: {status: {'count', 'total', 'last_activity'}}}` of `user`,
+        read with one indexed query.
+        """
+        totals = {cls.CREDIT: {}, cls.DEBIT: {}}
+        rows = cls.objects.filter(user=user).values_list(
+            'kind', 'status', 'count', 'total', 'last_activity')
+        for kind, status, count, total, last_activity in rows:
+            totals.setdefault(kind, {})[status] = {
+                'count': count,
+                'total': total,
+                'last_activity': last_activity,
+            }
+        return totals
+
+    @classmethod
+    def apply(cls, kind, changes):
+        """
+        Moves the summaries by `changes`, `(previous, current)` pairs of
+        `(user_id, status, cents, created_at)`, `None` for a row that did
+        not exist or has no user.
+        """
+        deltas = {}
+        for previous, current in changes:
+            if previous == current:
+                continue
+            for values, sign in ((previous, -1), (current, 1)):
+                if values is None:
+                    continue
+                user_id, status, cents, created_at = values
+                count, total, last = deltas.get((user_id, status),
+                                                (0, 0, None))
+                if sign > 0 and created_at is not None:
+                    last = max(last, created_at) if last else created_at
+                deltas[user_id, status] = (count + sign, total + sign * cents,
+                                           last)
+        for (user_id, status), (count, total, last) in deltas.items():
+            rows = cls.objects.filter(user=user_id, kind=kind, status=status)
+            if not rows.update(count=models.F('count') + count,
+                               total=models.F('total') + total):
+                try:
+                    with _atomic():
+                        cls.objects.create(user_id=user_id, kind=kind,
+                                           status=status, count=count,
+                                           total=total, last_activity=last)
+                    continue
+                except IntegrityError:
+                    # another transaction created it first
+                    rows.update(count=models.F('count') + count,
+                                total=models.F('total') + total)
+            if last is not None:
+                rows.filter(
+                    models.Q(last_activity__lt=last) |
+                    models.Q(last_activity__isnull=True),
+                ).update(last_activity=last)
+
+    @classmethod
+    def rebuild(cls, users=None):
+        """
+        Recomputes the summaries of `users` (default: everyone) from the
+        credits and debits tables, with one aggregate query per table.
+        """
+        summaries = []
+        for model in (Credit, Debit):
+            rows = model.objects.filter(user__isnull=False)
+            if users is not None:
+                rows = rows.filter(user__in=users)
+            group = ['user']
+            if 'status' in model._meta.get_all_field_names():
+                group.append('status')
+            rows = rows.values(*group).annotate(
+                count=models.Count('pk'),
+                total=models.Sum('amount'),
+                last_activity=models.Max('created_at'),
+            ).order_by()
+            for row in rows:
+                summaries.append(cls(
+                    user_id=row['user'],
+                    kind=model._summary_kind,
+                    status=row.get('status') or '',
+                    count=row['count'],
+                    total=_cents(row['total']),
+                    last_activity=row['last_activity'],
+                ))
+        with _atomic():
+            existing = cls.objects.all()
+            if users is not None:
+                existing = existing.filter(user__in=users)
+            existing.delete()
+            cls.objects.bulk_create(summaries)
+        return len(summaries)
+
+
+class PayoutBatch(models.Model):
+    """
+    A set of credits paid out in the background, see `django_balanced.payouts`.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    # stopped by an unexpected error, `run_payouts` resumes it
+    FAILED = 'failed'
+
+    created_by = models.ForeignKey(User, null=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True)
+    status = models.CharField(max_length=16, default=PENDING)
+    # tenant the credits are sent as
+    marketplace = models.CharField(max_length=64, default=tenants.DEFAULT)
+    # escrow held for the batch, settled once it finished
+    reservation = models.ForeignKey(EscrowReservation, null=True,
+                                    related_name='+')
+
+    class Meta:
+        db_table = 'balanced_payout_batches'
+
+    def __unicode__(self):
+        return 'Payout batch %s (%s)' % (self.pk, self.status)
+
+    def progress(self):
+        counts = dict.fromkeys(
+            (PayoutItem.PENDING, PayoutItem.SENDING,
+             PayoutItem.PAID, PayoutItem.FAILED), 0)
+        rows = self.items.values_list('status').annotate(models.Count('pk'))
+        for status, count in rows:
+            counts[status] = count
+        return counts
+
+
+class PayoutItem(models.Model):
+    PENDING = 'pending'
+    SENDING = 'sending'
+    PAID = 'paid'
+    FAILED = 'failed'
+
+    batch = models.ForeignKey(PayoutBatch, related_name='items')
+    bank_account = models.ForeignKey(BankAccount, related_name='+')
+    amount = models.IntegerField()  # cents
+    description = models.CharField(max_length=255, null=True)
+    # sent along as credit meta so a retried item can find its credit
+    idempotency_key = models.CharField(max_length=32, unique=True)
+    status = models.CharField(max_length=16, default=PENDING)
+    credit = models.ForeignKey(Credit, null=True, related_name='+')
+    error = models.TextField(null=True)
+
+    class Meta:
+        db_table = 'balanced_payout_items'
+
+    def __unicode__(self):
+        return '%s to %s (%s)' % (self.amount, self.bank_account_id,
+                                  self.status)
+
+
+class BalancedEvent(models.Model):
+    """
+    An event Balanced POSTed to the callback view, applied to the local
+    tables by `django_balanced.events.drain_events` as the tenant of the
+    marketplace it was received for.
+    """
+    id = models.CharField(primary_key=True, max_length=255)
+    type = models.CharField(max_length=255)
+    entity_uri = models.CharField(max_length=255, null=True)
+    marketplace = models.CharField(max_length=64, default=tenants.DEFAULT)
+    payload = models.TextField()
+    occurred_at = models.DateTimeField(null=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, db_index=True)
+    # times it could not be applied yet, retried after newer events
+    attempts = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        db_table = 'balanced_events'
+
+    def __unicode__(self):
+        return '%s %s' % (self.type, self.entity_uri)
+
 
-# this will create an account per user when they are next saved. subsequent
-# saves will not make a network call.
+# accounts are created lazily by Account.for_user, or for new users once
+# their signup committed when PROVISION_ACCOUNTS is 'on_commit'. saving an
+# existing user never costs a query.
 def create_user_profile(sender, instance, created, **kwargs):
-    Account.objects.get_or_create(user=instance)
+    if created:
+        from django_balanced.provisioning import provision_later
+        provision_later(instance.pk)
 
 
-post_save.connect(create_user_profile, sender=User)
+try:
+    from django.apps import AppConfig  # noqa
+except ImportError:
+    # django < 1.7 has no app registry to call BalancedConfig.ready()
+    from django_balanced.apps import setup
+    setup()
@@ -0,0 +1,153 @@
+from __future__ import unicode_literals
+from multiprocessing.pool import ThreadPool
+import logging
+import threading
+import uuid
+
+import balanced
+from django.conf import settings
+from django.db import connection
+from django.db.models import Sum
+from django.utils import timezone
+
+from django_balanced import escrow, tenants, throttle
+from django_balanced.models import (
+    Credit, PayoutBatch, PayoutItem, _atomic,
+)
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def create_batch(charges, user=None, reservation=None):
+    """
+    Persists a batch crediting each `(bank_account, amount, description)`
+    in `charges`, amounts in cents, as the current tenant. The escrow
+    `reservation` covering it is settled once the batch ran.
+    """
+    with _atomic():
+        batch = PayoutBatch.objects.create(created_by=user,
+                                           reservation=reservation,
+                                           marketplace=tenants.current().name)
+        PayoutItem.objects.bulk_create([
+            PayoutItem(batch=batch,
+                       bank_account=bank_account,
+                       amount=amount,
+                       description=description,
+                       idempotency_key=uuid.uuid4().hex)
+            for bank_account, amount, description in charges
+        ])
+    return batch
+
+
+def run_batch(batch, workers=None, recover=False):
+    """
+    Pays every pending item of `batch` using up to `workers` concurrent
+    credits (defaults to `BALANCED['PAYOUT_WORKERS']`).
+
+    With `recover`, items left half sent by an interrupted run are checked
+    against Balanced first: marked paid when their credit exists, retried
+    otherwise. Only use it when no other run is working on the batch.
+    """
+    with throttle.lane(throttle.BACKGROUND), \
+            tenants.activate(batch.marketplace):
+        _run_batch(batch, workers, recover)
+
+
+def _run_batch(batch, workers, recover):
+    workers = workers or settings.BALANCED['PAYOUT_WORKERS']
+    PayoutBatch.objects.filter(pk=batch.pk).update(
+        status=PayoutBatch.RUNNING)
+    if recover:
+        for item in batch.items.filter(status=PayoutItem.SENDING):
+            _recover_item(item)
+    status = PayoutBatch.FAILED
+    try:
+        item_ids = list(batch.items.filter(
+            status=PayoutItem.PENDING,
+        ).values_list('pk', flat=True))
+        if workers <= 1:
+            for item_id in item_ids:
+                _pay_item(item_id)
+        else:
+            pool = ThreadPool(workers)
+            try:
+                tenant = tenants.current()
+                pool.map(_pay_item_in_thread,
+                         [(item_id, tenant) for item_id in item_ids])
+            finally:
+                pool.close()
+                pool.join()
+        status = PayoutBatch.DONE
+    finally:
+        # whatever went wrong, the batch ends and the escrow it held is
+        # released but for what was paid
+        PayoutBatch.objects.filter(pk=batch.pk).update(
+            status=status, finished_at=timezone.now())
+        if batch.reservation_id is not None:
+            paid = batch.items.filter(status=PayoutItem.PAID).aggregate(
+                total=Sum('amount'))['total']
+            escrow.settle(batch.reservation, paid or 0)
+
+
+def run_batch_in_background(batch, workers=None):
+    # run_batch switches to the batch's tenant in the thread
+    def run():
+        try:
+            run_batch(batch, workers)
+        except Exception:
+            LOGGER.exception('Payout batch %s failed', batch.pk)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=run, name='payout-batch-%s' % batch.pk)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _pay_item(item_id):
+    # claiming the item first means it is never credited twice
+    claimed = PayoutItem.objects.filter(
+        pk=item_id, status=PayoutItem.PENDING,
+    ).update(status=PayoutItem.SENDING)
+    if not claimed:
+        return
+    item = PayoutItem.objects.select_related('bank_account').get(pk=item_id)
+    try:
+        item.credit = item.bank_account.credit(
+            item.amount, item.description,
+            meta={'idempotency_key': item.idempotency_key},
+        )
+    except balanced.exc.HTTPError as ex:
+        item.status = PayoutItem.FAILED
+        item.error = '%s' % ex
+    else:
+        item.status = PayoutItem.PAID
+    item.save()
+
+
+def _pay_item_in_thread(args):
+    item_id, tenant = args
+    try:
+        with throttle.lane(throttle.BACKGROUND), tenants.activate(tenant):
+            _pay_item(item_id)
+    finally:
+        # every worker thread has its own connection, don't leak them
+        connection.close()
+
+
+def _recover_item(item):
+    credits = Credit._query().filter(
+        **{'meta.idempotency_key': item.idempotency_key})
+    credit = next(iter(credits), None)
+    if credit is None:
+        item.status = PayoutItem.PENDING
+    else:
+        django_credit = Credit(bank_account=item.bank_account,
+                               user=item.bank_account.user)
+        django_credit._sync(credit)
+        django_credit.save()
+        item.credit = django_credit
+        item.status = PayoutItem.PAID
+    item.save()
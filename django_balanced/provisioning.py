@@ -0,0 +1,133 @@
+from __future__ import unicode_literals
+from multiprocessing.pool import ThreadPool
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+from django.contrib.auth.models import User
+from django.core.signals import request_finished
+from django.db import connection, transaction
+
+from django_balanced import tenants, throttle
+from django_balanced.models import Account
+
+
+LOGGER = logging.getLogger(__name__)
+
+_pending = queue.Queue()
+_lock = threading.Lock()
+_worker = None
+# users waiting for the end of the request of this thread, django < 1.9
+_deferred = threading.local()
+
+
+def provision(user_id):
+    return Account.for_user(User.objects.get(pk=user_id))
+
+
+def provision_later(user_id):
+    """
+    Queues the balanced account of the user for creation by a background
+    thread as the current tenant, once the current transaction committed.
+    Accounts still queued when the process exits are picked up by the
+    `provision_accounts` command.
+
+    Django < 1.9 has no commit hook: outside a transaction the account is
+    queued straight away, inside one it waits for the end of the request,
+    when the transaction of the request has been committed. A transaction
+    outside a request must be committed before calling this.
+    """
+    tenant = tenants.current()
+    on_commit = getattr(transaction, 'on_commit', None)
+    if on_commit is not None:
+        on_commit(lambda: _enqueue(user_id, tenant))
+    elif _in_transaction():
+        if not hasattr(_deferred, 'users'):
+            _deferred.users = []
+        _deferred.users.append((user_id, tenant))
+    else:
+        _enqueue(user_id, tenant)
+
+
+def _in_transaction():
+    in_atomic_block = getattr(connection, 'in_atomic_block', None)
+    if in_atomic_block is None:  # django < 1.6
+        return transaction.is_managed()
+    return in_atomic_block
+
+
+def _enqueue_deferred(**kwargs):
+    users, _deferred.users = getattr(_deferred, 'users', []), []
+    for user_id, tenant in users:
+        _enqueue(user_id, tenant)
+
+request_finished.connect(_enqueue_deferred,
+                         dispatch_uid='django_balanced.provisioning')
+
+
+def _enqueue(user_id, tenant):
+    global _worker
+    with _lock:
+        if _worker is None:
+            _worker = threading.Thread(target=_work,
+                                       name='balanced-provisioning')
+            _worker.daemon = True
+            _worker.start()
+    _pending.put((user_id, tenant))
+
+
+def _work():
+    while True:
+        user_id, tenant = _pending.get()
+        try:
+            with throttle.lane(throttle.BACKGROUND), \
+                    tenants.activate(tenant):
+                provision(user_id)
+        except Exception:
+            LOGGER.exception('Could not provision a balanced account for '
+                             'user %s', user_id)
+        finally:
+            connection.close()
+
+
+def backfill(workers=1):
+    """
+    Creates the balanced accounts of every user lacking one in the current
+    tenant's marketplace, `workers` at a time. Returns how many were
+    created.
+    """
+    with throttle.lane(throttle.BACKGROUND):
+        return _backfill(workers)
+
+
+def _backfill(workers):
+    user_ids = list(User.objects.exclude(
+        pk__in=Account.objects.for_marketplace().values('user'),
+    ).values_list('pk', flat=True))
+    if workers <= 1:
+        for user_id in user_ids:
+            provision(user_id)
+        return len(user_ids)
+    pool = ThreadPool(workers)
+    try:
+        tenant = tenants.current()
+        pool.map(_provision_in_thread,
+                 [(user_id, tenant) for user_id in user_ids])
+    finally:
+        pool.close()
+        pool.join()
+    return len(user_ids)
+
+
+def _provision_in_thread(args):
+    user_id, tenant = args
+    try:
+        with throttle.lane(throttle.BACKGROUND), tenants.activate(tenant):
+            provision(user_id)
+    finally:
+        # every worker thread has its own connection, don't leak them
+        connection.close()
@@ -0,0 +1,159 @@
+"""
+Checks that local payments match Balanced without downloading them again.
+
+The period is cut into buckets of `created_at`. A range of buckets matches
+when Balanced reports as many resources in it, in total and per status, as
+the local table holds, which takes a single page per count; amount sums
+would need every resource. Ranges that differ are halved until single
+buckets remain, and only those buckets are fetched and compared resource by
+resource.
+"""
+from __future__ import unicode_literals
+from collections import defaultdict
+from datetime import timedelta
+
+from django_balanced import metrics, tenants, throttle
+
+
+# fields compared between local rows and remote resources, where the model
+# has them
+COMPARED_FIELDS = ('status', 'amount')
+
+
+class _Summary(object):
+
+    def __init__(self):
+        self.count = 0
+        self.statuses = defaultdict(int)
+
+    def add(self, status):
+        self.count += 1
+        self.statuses[status] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        for status, count in other.statuses.items():
+            self.statuses[status] += count
+
+
+class Reconciliation(object):
+    """
+    Compares the rows of `model` the current tenant holds, created between
+    `since` and `until`, with Balanced, in buckets of `bucket` (a
+    timedelta). `run()` fills in `missing` (remote uris not stored
+    locally), `extra` (local uris unknown to Balanced) and `diverged`
+    (`(uri, field, local, remote)` tuples).
+    With `fix`, missing and diverged rows are written from the remote copy.
+    """
+
+    def __init__(self, model, since, until, bucket=timedelta(days=1),
+                 fix=False):
+        self.model = model
+        self.since = since
+        self.until = until
+        self.bucket = bucket
+        self.fix = fix
+        names = model._meta.get_all_field_names()
+        self.fields = [f for f in COMPARED_FIELDS if f in names]
+        self.missing = []
+        self.extra = []
+        self.diverged = []
+        self.buckets = 0
+        self.fetched = 0
+        self.round_trips = 0
+
+    def _bounds(self, index):
+        start = self.since + self.bucket * index
+        return start, min(start + self.bucket, self.until)
+
+    def _index(self, created_at):
+        delta = created_at - self.since
+        seconds = delta.days * 86400 + delta.seconds
+        bucket = self.bucket.days * 86400 + self.bucket.seconds
+        return int(seconds // bucket)
+
+    def _local(self, start, end):
+        return self.model.objects.for_marketplace().filter(
+            created_at__gte=start, created_at__lt=end)
+
+    def _remote(self, start, end, status=None):
+        f = self.model._resource.f
+        query = self.model._query().filter(
+            f.created_at >= start.isoformat()).filter(
+            f.created_at < end.isoformat())
+        if status is not None:
+            query = query.filter(f.status == status)
+        return query
+
+    def _count(self, start, end, status=None):
+        with metrics.operation('reconcile'):
+            return self._remote(start, end, status).count()
+
+    def run(self):
+        started = metrics.round_trips()
+        with throttle.lane(throttle.BACKGROUND):
+            leaves = [_Summary() for _ in range(
+                max(self._index(self.until - timedelta(microseconds=1)) + 1,
+                    0))]
+            self.buckets = len(leaves)
+            counted = 'status' if 'status' in self.fields else 'created_at'
+            rows = self._local(self.since, self.until).values_list(
+                'created_at', counted)
+            for created_at, status in rows.iterator():
+                if counted != 'status':
+                    status = None
+                leaves[self._index(created_at)].add(status)
+            if leaves:
+                self._compare(leaves, 0, len(leaves))
+        self.round_trips = metrics.round_trips() - started
+        return self
+
+    def _compare(self, leaves, first, last, remote_count=None):
+        start, end = self._bounds(first)[0], self._bounds(last - 1)[1]
+        local = _Summary()
+        for leaf in leaves[first:last]:
+            local.merge(leaf)
+        if remote_count is None:
+            remote_count = self._count(start, end)
+        matches = remote_count == local.count and all(
+            self._count(start, end, status) == count
+            for status, count in local.statuses.items()
+            if status is not None)
+        if matches:
+            return
+        if last - first == 1:
+            self._diff(start, end)
+            return
+        middle = (first + last) // 2
+        left = self._count(start, self._bounds(middle)[0])
+        self._compare(leaves, first, middle, left)
+        # the right half holds whatever the left one does not
+        self._compare(leaves, middle, last, remote_count - left)
+
+    def _diff(self, start, end):
+        self.fetched += 1
+        with metrics.operation('reconcile'):
+            remote = dict((r.uri, r) for r in self._remote(start, end))
+        local = dict(
+            (row[0], row[1:])
+            for row in self._local(start, end).values_list(
+                'uri', *self.fields))
+        self.extra.extend(sorted(set(local) - set(remote)))
+        changed = []
+        for uri in sorted(remote):
+            if uri not in local:
+                self.missing.append(uri)
+                changed.append(remote[uri])
+                continue
+            # compare what a sync would store
+            probe = self.model()
+            probe._sync(remote[uri])
+            for field, value in zip(self.fields, local[uri]):
+                if getattr(probe, field) != value:
+                    self.diverged.append(
+                        (uri, field, value, getattr(probe, field)))
+                    changed.append(remote[uri])
+        if self.fix and changed:
+            # diverged rows still carry the fingerprint of the payload
+            self.model._sync_chunk(list(dict(
+                (r.uri, r) for r in changed).values()), force=True)
@@ -1,4 +1,3 @@
-import os
 import logging
 
 from django.conf import settings
@@ -9,31 +8,57 @@ LOGGER = logging.getLogger(__name__)
 BALANCED = getattr(settings, 'BALANCED', {})
 BALANCED.setdefault('DASHBOARD_URL', 'https://www.balancedpayments.com')
 BALANCED.setdefault('API_URL', 'https://api.balancedpayments.com')
-
-installed_apps = getattr(settings, 'INSTALLED_APPS', ())
-ctx_processors = getattr(settings, 'TEMPLATE_CONTEXT_PROCESSORS', [])
-middlware_clss = getattr(settings, 'MIDDLEWARE_CLASSES', ())
-
-installed_apps += (
-    'django_balanced',
-)
-ctx_processors = [
-    'django_balanced.context_processors.balanced_library',
-    'django_balanced.context_processors.balanced_settings',
-    'django.contrib.auth.context_processors.auth',
-]
-middlware_clss += (
-    'django_balanced.middleware.BalancedMiddleware',
-)
-
-settings.INSTALLED_APPS = installed_apps
-settings.TEMPLATE_CONTEXT_PROCESSORS = ctx_processors
-settings.MIDDLEWARE_CLASSES = middlware_clss
-
-PROJECT_PATH = os.path.realpath(os.path.dirname(__file__))
-settings.TEMPLATE_DIRS += (
-    PROJECT_PATH + '/' + 'templates',
-)
+# django cache used for remote resources fetched with `find()`, and for how
+# many seconds they are kept (0 only dedupes lookups within a request)
+BALANCED.setdefault('CACHE_ALIAS', 'default')
+BALANCED.setdefault('CACHE_TTL', 30)
+# pooled keep-alive transport shared by every call to the Balanced API,
+# timeouts are in seconds
+BALANCED.setdefault('HTTP_POOL_SIZE', 10)
+BALANCED.setdefault('HTTP_CONNECT_TIMEOUT', 5)
+BALANCED.setdefault('HTTP_READ_TIMEOUT', 30)
+BALANCED.setdefault('HTTP_RETRIES', 2)
+BALANCED.setdefault('HTTP_BACKOFF', 0.2)
+# when to create the balanced account of a user: 'lazy' on first payment,
+# or 'on_commit' in the background once a new user was saved
+BALANCED.setdefault('PROVISION_ACCOUNTS', 'lazy')
+# threads running the asyncio operations of django_balanced.aio
+BALANCED.setdefault('ASYNC_WORKERS', 10)
+# calls per second made to the Balanced API (None disables the limit), how
+# many may burst at once and whether processes share the limit through the
+# django cache
+BALANCED.setdefault('RATE_LIMIT', 25)
+BALANCED.setdefault('RATE_LIMIT_BURST', 25)
+BALANCED.setdefault('RATE_LIMIT_SHARED', False)
+# retries of rate limited (429) and failed (5xx) calls, with a jittered
+# exponential backoff starting at RETRY_BACKOFF seconds
+BALANCED.setdefault('RETRY_ATTEMPTS', 5)
+BALANCED.setdefault('RETRY_BACKOFF', 0.5)
+BALANCED.setdefault('RETRY_BACKOFF_MAX', 30)
+# concurrent credits sent by a background bulk payout
+BALANCED.setdefault('PAYOUT_WORKERS', 4)
+# concurrent finds made by refresh_from_balanced
+BALANCED.setdefault('REFRESH_WORKERS', 8)
+# shared secret Balanced must pass to the callback view, which rejects
+# every event while it is unset
+BALANCED.setdefault('CALLBACK_SECRET', None)
+# dotted path of the class recording timings and counts of remote calls and
+# sync steps, e.g. 'django_balanced.metrics.StatsdMetrics', and the keyword
+# arguments it is created with. metrics are always sent as signals too
+BALANCED.setdefault('METRICS_BACKEND', None)
+BALANCED.setdefault('METRICS_OPTIONS', {})
+# number of remote resources upserted per transaction by `sync`
+BALANCED.setdefault('SYNC_CHUNK_SIZE', 500)
+# chunks fetched ahead while the current one is written, 0 disables
+BALANCED.setdefault('SYNC_PREFETCH', 2)
+# rows read per query while exporting
+BALANCED.setdefault('EXPORT_CHUNK_SIZE', 2000)
+# further marketplaces served next to API_KEY's, by name, as dicts of their
+# API_KEY and optionally the CACHE_ALIAS of their cached resources, and the
+# dotted path of the callable picking the name for a request, see
+# django_balanced.tenants
+BALANCED.setdefault('MARKETPLACES', {})
+BALANCED.setdefault('TENANT_RESOLVER', None)
 
 if not BALANCED.get('API_KEY'):
     LOGGER.error('You must set the BALANCED_API_KEY environment variable.')
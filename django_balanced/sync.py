@@ -0,0 +1,118 @@
+from __future__ import unicode_literals
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connection
+
+from django_balanced import tenants, throttle
+from django_balanced.models import (
+    Account, BalancedResource, SyncWatermark, _ChunkProgress,
+)
+
+
+def sync_models():
+    """
+    Every `BalancedResource` model grouped into waves that can be synced
+    concurrently: a model only appears after the models its rows point to.
+    """
+    models = BalancedResource.__subclasses__()
+    dependencies = {}
+    for model in models:
+        dependencies[model] = set(
+            f.rel.to for f in model._meta.fields
+            if f.rel and f.rel.to in models and f.rel.to is not model
+        )
+        # users are resolved through the balanced account the row belongs to
+        names = model._meta.get_all_field_names()
+        if model is not Account and 'user' in names:
+            dependencies[model].add(Account)
+    waves = []
+    done = set()
+    while len(done) < len(models):
+        wave = [m for m in models
+                if m not in done and dependencies[m] <= done]
+        if not wave:
+            raise ValueError('Cyclic dependencies between %s' % ', '.join(
+                m.__name__ for m in models if m not in done))
+        waves.append(wave)
+        done.update(wave)
+    return waves
+
+
+def sync_all(models=None, workers=1, chunk_size=None, incremental=False):
+    """
+    Syncs `models` (default: every `BalancedResource`), respecting foreign
+    key order. With more than one worker, the models of a wave and the page
+    ranges of each model are fetched and written concurrently by a pool of
+    `workers` threads.
+
+    Returns a list of `(model, stats)` pairs.
+    """
+    with throttle.lane(throttle.BACKGROUND):
+        return _sync_all(models, workers, chunk_size, incremental)
+
+
+def _sync_all(models, workers, chunk_size, incremental):
+    waves = sync_models()
+    if models is not None:
+        waves = [[m for m in wave if m in models] for wave in waves]
+    results = []
+    if workers <= 1:
+        for wave in waves:
+            for model in wave:
+                results.append((model, model.sync(chunk_size, incremental)))
+        return results
+    pool = ThreadPool(workers)
+    try:
+        for wave in waves:
+            pending = [(model, _sync_ranges(pool, model, chunk_size,
+                                            incremental))
+                       for model in wave]
+            for model, (watermark, chunks) in pending:
+                stats = dict.fromkeys(
+                    ('inserted', 'updated', 'skipped', 'unresolved'), 0)
+                # imap hands results back in order, so the watermark only
+                # moves past chunks once everything before them is written
+                for progress, chunk_stats in chunks:
+                    for key, count in chunk_stats.items():
+                        stats[key] += count
+                    if progress is not None:
+                        watermark.advance(progress.resources,
+                                          progress.unresolved)
+                results.append((model, stats))
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def _sync_ranges(pool, model, chunk_size, incremental):
+    chunk_size = chunk_size or settings.BALANCED['SYNC_CHUNK_SIZE']
+    tenant = tenants.current()
+    watermark, _ = SyncWatermark.objects.get_or_create(
+        resource=tenant.qualify(model.__name__))
+    since = watermark.created_at if incremental else None
+    total = model._sync_query(since).count()
+    ranges = [(model, since, offset, offset + chunk_size, tenant)
+              for offset in range(0, total, chunk_size)]
+    return watermark, pool.imap(_sync_range, ranges)
+
+
+def _sync_range(args):
+    model, since, start, stop, tenant = args
+    try:
+        with tenants.activate(tenant):
+            with throttle.lane(throttle.BACKGROUND):
+                # slicing a query skips `start` resources a second time, so
+                # the range gets a query of its own
+                query = model._sync_query(since).filter(
+                    offset=start, limit=stop - start)
+                resources = list(islice(query, stop - start))
+            if not resources:
+                return None, {}
+            progress = _ChunkProgress()
+            return progress, model._sync_chunk(resources, progress)
+    finally:
+        # every worker thread has its own connection, don't leak them
+        connection.close()
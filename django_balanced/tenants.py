@@ -0,0 +1,126 @@
+"""
+Several marketplaces served by one process. Each is a tenant with its own
+API key, connection pool, rate limit and cache keys::
+
+    BALANCED = {
+        'API_KEY': ...,  # the 'default' tenant
+        'MARKETPLACES': {
+            'acme': {'API_KEY': ..., 'CACHE_ALIAS': 'acme'},
+        },
+        'TENANT_RESOLVER': 'myproject.tenancy.marketplace_for_request',
+    }
+
+Calls to Balanced go out for the tenant active in the calling thread, the
+default one unless a block runs under `activate(name)`. `BalancedMiddleware`
+activates the tenant the resolver picks for each request; jobs activate
+theirs, and the thread pools of syncs, refreshes and payouts hand it on to
+their workers. Tenants are created once and never shared between
+marketplaces, so threads serving different ones do not wait on each other.
+"""
+from __future__ import unicode_literals
+from contextlib import contextmanager
+from importlib import import_module
+import threading
+
+from django.conf import settings
+
+
+DEFAULT = 'default'
+
+_local = threading.local()
+_lock = threading.Lock()
+_tenants = {}
+_resolver = None
+
+
+class UnknownTenant(KeyError):
+    pass
+
+
+class Tenant(object):
+    """
+    The client context of one marketplace. The default tenant has no key of
+    its own and uses the one `balanced.configure()` set.
+    """
+
+    def __init__(self, name, api_key=None, cache_alias=None):
+        self.name = name
+        self.api_key = api_key
+        self.cache_alias = cache_alias
+        # created on first use by transport and throttle, under `lock`
+        self.lock = threading.Lock()
+        self.session = None
+        self.bucket = None
+
+    def __repr__(self):
+        return '<Tenant %s>' % self.name
+
+    def qualify(self, name):
+        """
+        `name`, e.g. a cache key, made unique to this tenant. The default
+        tenant's names are left as they are.
+        """
+        if self.name == DEFAULT:
+            return name
+        return '%s:%s' % (self.name, name)
+
+
+def get(name=DEFAULT):
+    """
+    The tenant named `name` in `BALANCED['MARKETPLACES']`, or the default
+    one. Raises `UnknownTenant` for other names.
+    """
+    tenant = _tenants.get(name)
+    if tenant is None:
+        with _lock:
+            tenant = _tenants.get(name)
+            if tenant is None:
+                if name == DEFAULT:
+                    tenant = Tenant(DEFAULT)
+                else:
+                    try:
+                        config = settings.BALANCED['MARKETPLACES'][name]
+                    except KeyError:
+                        raise UnknownTenant(name)
+                    tenant = Tenant(name, config['API_KEY'],
+                                    config.get('CACHE_ALIAS'))
+                _tenants[name] = tenant
+    return tenant
+
+
+def current():
+    """
+    The tenant active in this thread.
+    """
+    tenant = getattr(_local, 'tenant', None)
+    return tenant if tenant is not None else get(DEFAULT)
+
+
+@contextmanager
+def activate(name):
+    """
+    Talks to Balanced as the tenant `name` (or a `Tenant`) for the block,
+    in this thread only. `None` keeps the current tenant.
+    """
+    outer = getattr(_local, 'tenant', None)
+    if name is not None:
+        _local.tenant = name if isinstance(name, Tenant) else get(name)
+    try:
+        yield current()
+    finally:
+        _local.tenant = outer
+
+
+def resolve(request):
+    """
+    The name of the tenant serving `request`, as picked by the callable
+    `BALANCED['TENANT_RESOLVER']` points to, or None for the default one.
+    """
+    global _resolver
+    path = settings.BALANCED['TENANT_RESOLVER']
+    if not path:
+        return None
+    if _resolver is None:
+        module, _, name = path.rpartition('.')
+        _resolver = getattr(import_module(module), name)
+    return _resolver(request)
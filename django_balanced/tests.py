@@ -1,13 +1,50 @@
 from __future__ import unicode_literals
+from datetime import datetime, timedelta
+from decimal import Decimal
+from itertools import count, islice
+import json
+import sys
+import threading
+import time
+import unittest
+
+try:
+    import asyncio
+except ImportError:  # python 2
+    asyncio = None
+
+try:
+    from http.server import BaseHTTPRequestHandler
+except ImportError:  # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler
 
 import balanced
 import mock
 
+from django.conf import settings
+from django.conf.urls import include, patterns, url
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.signals import request_finished
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.utils import timezone
+from django.utils.six import StringIO
 from django.contrib.auth.models import User
 
-from django_balanced import models
+from django_balanced import (
+    admin as balanced_admin, benchmarks, cache, escrow, events, export,
+    marketplace, metrics, models, payouts, provisioning, reconcile, sync,
+    tenants, throttle, transport,
+)
+from django_balanced.fake import EPOCH, FakeBalanced, _ThreadingHTTPServer
+
 
+# for the tests going through the admin
+urlpatterns = patterns(
+    '',
+    url(r'^admin/', include(balanced_admin.admin.site.urls)),
+)
 
 # https://www.balancedpayments.com/docs/testing
 FIXTURES = {
@@ -38,7 +75,7 @@ class ModelsTest(TestCase):
 
         card = balanced.Card(**FIXTURES['card']).save()
         cls.card = models.Card.create_from_card_uri(cls.user, card.uri)
-        cls.buyer = cls.card.user.balanced_account
+        cls.buyer = models.Account.for_user(cls.card.user)
         # put some money in the escrow account
         cls.buyer.debit(100 * 100, 'test')  # $100.00
 
@@ -61,3 +98,1124 @@ class ModelsTest(TestCase):
         bank_account.save()
         self.assertTrue(bank_account.bank_name)
         self.assertTrue(bank_account.uri)
+
+
+class FakeResource(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class SyncTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('jane', 'jane@test.com', 'pass')
+        models.BankAccount.objects.bulk_create([
+            models.BankAccount(uri='/v1/bank_accounts/BA1', id='BA1',
+                               user=self.user,
+                               created_at=datetime(2013, 1, 1)),
+        ])
+
+    def _credit(self, index, **kwargs):
+        data = {
+            'id': 'CR%d' % index,
+            'uri': '/v1/credits/CR%d' % index,
+            'created_at': datetime(2013, 1, 2),
+            'amount': 1050,
+            'description': 'payout',
+            'status': 'pending',
+            'bank_account_uri': '/v1/bank_accounts/BA1',
+        }
+        data.update(kwargs)
+        return FakeResource(**data)
+
+    def test_sync_inserts_in_chunks(self):
+        remote = [self._credit(i) for i in range(5)]
+        with mock.patch.object(models.Credit, '_query') as query:
+            query.return_value.sort.return_value = remote
+            stats = models.Credit.sync(chunk_size=2)
+        self.assertEqual(stats['inserted'], 5)
+        credit = models.Credit.objects.get(uri='/v1/credits/CR3')
+        self.assertEqual(credit.amount, Decimal('10.50'))
+        self.assertEqual(credit.user, self.user)
+
+    def test_rows_synced_before_their_account_get_its_user(self):
+        models.Card.objects.bulk_create([
+            models.Card(uri='/v1/cards/CC1', id='CC1', user=self.user,
+                        created_at=datetime(2013, 1, 1), expiration_month=1,
+                        expiration_year=2020),
+        ])
+        owner = User.objects.create_user('joe', 'joe@test.com', 'pass')
+        bank_account = FakeResource(
+            id='BA2', uri='/v1/bank_accounts/BA2',
+            created_at=datetime(2013, 1, 2), account_uri='/v1/accounts/AC1')
+        debit = FakeResource(
+            id='WD1', uri='/v1/debits/WD1', created_at=datetime(2013, 1, 2),
+            amount=1050, description='order', status='succeeded',
+            source_uri='/v1/cards/CC1', account_uri='/v1/accounts/AC1')
+        account = FakeResource(id='AC1', uri='/v1/accounts/AC1',
+                               created_at=datetime(2013, 1, 1), name='joe')
+        models.BankAccount._sync_chunk([bank_account])
+        self.assertEqual(models.Debit._sync_chunk([debit])['unresolved'], 1)
+        self.assertIsNone(models.BankAccount.objects.get(
+            uri='/v1/bank_accounts/BA2').user)
+        models.Account._sync_chunk([account])
+        models.BankAccount._sync_chunk([bank_account])
+        models.Debit._sync_chunk([debit])
+        self.assertEqual(models.BankAccount.objects.get(
+            uri='/v1/bank_accounts/BA2').user, owner)
+        self.assertEqual(models.Debit.objects.get().user, owner)
+
+    def test_sync_updates_changed_rows_only(self):
+        with mock.patch.object(models.Credit, '_query') as query:
+            query.return_value.sort.return_value = [self._credit(1),
+                                                    self._credit(2)]
+            models.Credit.sync()
+            query.return_value.sort.return_value = [
+                self._credit(1),
+                self._credit(2, status='paid'),
+                self._credit(3, bank_account_uri='/v1/nope'),
+            ]
+            stats = models.Credit.sync()
+        self.assertEqual(stats['updated'], 1)
+        self.assertEqual(stats['skipped'], 1)
+        self.assertEqual(stats['unresolved'], 1)
+        self.assertEqual(
+            models.Credit.objects.get(uri='/v1/credits/CR2').status, 'paid')
+
+    def test_bulk_update_writes_a_chunk_with_one_query(self):
+        with mock.patch.object(models.Credit, '_query') as query:
+            query.return_value.sort.return_value = [
+                self._credit(i) for i in range(3)]
+            models.Credit.sync()
+        credits = list(models.Credit.objects.order_by('pk'))
+        for i, credit in enumerate(credits):
+            credit.status = 'paid%d' % i
+            credit.amount = Decimal('1.25') * i
+            credit.created_at += timedelta(days=i)
+        fields = [models.Credit._meta.get_field(name)
+                  for name in ('status', 'amount', 'created_at')]
+        with self.assertNumQueries(1):
+            models._bulk_update(models.Credit, credits, fields)
+        self.assertEqual(
+            list(models.Credit.objects.order_by('pk').values_list(
+                'status', 'amount', 'created_at')),
+            [(c.status, c.amount, c.created_at) for c in credits])
+
+    def test_sync_skips_rows_with_the_same_fingerprint(self):
+        with mock.patch.object(models.Credit, '_query') as query:
+            query.return_value.sort.return_value = [self._credit(1)]
+            models.Credit.sync()
+            with mock.patch.object(models.Credit, '_sync') as hydrate:
+                stats = models.Credit.sync()
+        self.assertFalse(hydrate.called)
+        self.assertEqual(stats['skipped'], 1)
+        self.assertEqual(
+            models.Credit.objects.get().fingerprint,
+            models._fingerprint(self._credit(1)))
+
+    def test_sync_keeps_payment_summaries_current(self):
+        with mock.patch.object(models.Credit, '_query') as query:
+            query.return_value.sort.return_value = [self._credit(1),
+                                                    self._credit(2)]
+            models.Credit.sync()
+            query.return_value.sort.return_value = [
+                self._credit(1),
+                self._credit(2, status='paid', amount=2000),
+            ]
+            models.Credit.sync()
+        totals = models.PaymentSummary.totals(self.user)['credit']
+        self.assertEqual(totals['pending']['count'], 1)
+        self.assertEqual(totals['pending']['total'], 1050)
+        self.assertEqual(totals['paid']['total'], 2000)
+        last_activity = datetime(2013, 1, 2)
+        if settings.USE_TZ:
+            last_activity = timezone.make_aware(last_activity, timezone.utc)
+        self.assertEqual(totals['paid']['last_activity'], last_activity)
+        self.assertEqual(models.PaymentSummary.rebuild(), 2)
+        self.assertEqual(
+            models.PaymentSummary.totals(self.user)['credit'], totals)
+
+    def test_summaries_keep_every_cent(self):
+        # sqlite sums decimals as floats on some versions, 0.29 * 100 is
+        # 28.999999999999996
+        self.assertEqual(models._cents(0.29), 29)
+        self.assertEqual(models._cents(Decimal('10.50')), 1050)
+        self.assertEqual(models._cents(None), 0)
+        with mock.patch.object(models.Credit, '_query') as query:
+            query.return_value.sort.return_value = [
+                self._credit(1, amount=29)]
+            models.Credit.sync()
+        models.PaymentSummary.rebuild()
+        totals = models.PaymentSummary.totals(self.user)['credit']
+        self.assertEqual(totals['pending']['total'], 29)
+
+    @mock.patch.dict(settings.BALANCED,
+                     MARKETPLACES={'acme': {'API_KEY': 'ak-acme'}})
+    def test_rows_record_the_marketplace_they_were_synced_for(self):
+        with mock.patch.object(models.Credit, '_query') as query:
+            query.return_value.sort.return_value = [self._credit(1)]
+            with tenants.activate('acme'):
+                models.Credit.sync(incremental=True)
+                self.assertEqual(
+                    models.Credit.objects.for_marketplace().count(), 1)
+        self.assertEqual(models.Credit.objects.get().marketplace, 'acme')
+        self.assertFalse(models.Credit.objects.for_marketplace().exists())
+        self.assertTrue(models.SyncWatermark.objects.filter(
+            resource='acme:Credit').exists())
+
+    @mock.patch.dict(settings.BALANCED,
+                     MARKETPLACES={'acme': {'API_KEY': 'ak-acme'}})
+    def test_queries_go_to_the_marketplace_of_the_tenant(self):
+        self.addCleanup(marketplace._marketplace_uris.clear)
+        with mock.patch.object(balanced.Marketplace, 'query') as query:
+            query.one.side_effect = lambda: FakeResource(
+                uri='/v1/marketplaces/MP-%s' % marketplace._api_key())
+            with tenants.activate('acme'):
+                acme = models.Debit._query().uri
+            default = models.Debit._query().uri
+        self.assertEqual(acme, '/v1/marketplaces/MP-ak-acme/debits')
+        self.assertNotEqual(default, acme)
+        self.assertEqual(models.Credit._query().uri, 'credits')
+
+    def test_fingerprint_ignores_how_related_resources_are_embedded(self):
+        embedded = self._credit(1, bank_account=FakeResource(
+            uri='/v1/bank_accounts/BA1'))
+        del embedded.bank_account_uri
+        self.assertEqual(models._fingerprint(embedded),
+                         models._fingerprint(self._credit(1)))
+        self.assertNotEqual(models._fingerprint(self._credit(1)),
+                            models._fingerprint(self._credit(1, amount=1)))
+
+    def test_incremental_sync_resumes_from_watermark(self):
+        with mock.patch.object(models.Credit, '_query') as query:
+            query.return_value.sort.return_value = [
+                self._credit(1),
+                self._credit(2, created_at=datetime(2013, 2, 1)),
+            ]
+            models.Credit.sync(chunk_size=1)
+            watermark = models.SyncWatermark.objects.get(resource='Credit')
+            self.assertEqual(watermark.uri, '/v1/credits/CR2')
+
+            filtered = query.return_value.filter.return_value
+            filtered.sort.return_value = [self._credit(3)]
+            stats = models.Credit.sync(incremental=True)
+        (since,), _ = query.return_value.filter.call_args
+        self.assertEqual((since.field.name, since.op, since.value),
+                         ('created_at', '>=',
+                          watermark.created_at.isoformat()))
+        self.assertEqual(stats['inserted'], 1)
+
+    def test_watermark_stops_before_unresolved_rows(self):
+        remote = [
+            self._credit(1, created_at=datetime(2013, 1, 1)),
+            self._credit(2, created_at=datetime(2013, 1, 2),
+                         bank_account_uri='/v1/bank_accounts/BA2'),
+            self._credit(3, created_at=datetime(2013, 1, 3)),
+        ]
+        with mock.patch.object(models.Credit, '_query') as query:
+            query.return_value.sort.return_value = remote
+            stats = models.Credit.sync(chunk_size=1)
+            self.assertEqual(stats['unresolved'], 1)
+            watermark = models.SyncWatermark.objects.get(resource='Credit')
+            self.assertEqual(watermark.uri, '/v1/credits/CR1')
+
+            models.BankAccount.objects.bulk_create([models.BankAccount(
+                uri='/v1/bank_accounts/BA2', id='BA2', user=self.user,
+                created_at=datetime(2013, 1, 1))])
+            query.return_value.filter.return_value.sort.return_value = \
+                remote
+            stats = models.Credit.sync(incremental=True)
+        self.assertEqual(stats['inserted'], 1)
+        self.assertEqual(
+            models.SyncWatermark.objects.get(resource='Credit').uri,
+            '/v1/credits/CR3')
+
+    def test_sync_models_respects_foreign_keys(self):
+        waves = sync.sync_models()
+        self.assertEqual(waves[0], [models.Account])
+        self.assertEqual(set(waves[1]), set([models.BankAccount, models.Card]))
+        self.assertEqual(set(waves[2]), set([models.Credit, models.Debit]))
+
+    def test_sync_resolves_users_through_accounts(self):
+        models.Account.objects.bulk_create([
+            models.Account(uri='/v1/accounts/AC1', id='AC1', user=self.user,
+                           created_at=datetime(2013, 1, 1)),
+        ])
+        card = FakeResource(id='CC1', uri='/v1/cards/CC1',
+                            created_at=datetime(2013, 1, 1),
+                            name='jane', expiration_month=12,
+                            expiration_year=2020, last_four='1111',
+                            brand='visa', account_uri='/v1/accounts/AC1')
+        with mock.patch.object(models.Card, '_query') as query:
+            query.return_value.sort.return_value = [card]
+            stats = models.Card.sync()
+        self.assertEqual(stats['inserted'], 1)
+        self.assertEqual(self.user.cards.get().uri, '/v1/cards/CC1')
+
+    def test_prefetch_is_bounded_and_propagates_errors(self):
+        produced = []
+
+        def pages():
+            for i in range(5):
+                produced.append(i)
+                yield i
+            raise balanced.exc.HTTPError('boom')
+
+        pipeline = models._prefetch(pages(), 1)
+        self.assertEqual(next(pipeline), 0)
+        # one item handed out, at most one buffered and one waiting to be
+        self.assertTrue(len(produced) <= 3)
+        self.assertEqual(list(islice(pipeline, 4)), [1, 2, 3, 4])
+        self.assertRaises(balanced.exc.HTTPError, list, pipeline)
+
+    def test_sync_plan_resolves_foreign_keys_and_cents(self):
+        models.Card.objects.bulk_create([
+            models.Card(uri='/v1/cards/CC1', id='CC1', user=self.user,
+                        created_at=datetime(2013, 1, 1), expiration_month=1,
+                        expiration_year=2020),
+        ])
+        debit = models.Debit()
+        debit._sync(FakeResource(
+            id='WD1', uri='/v1/debits/WD1', amount=1999,
+            created_at='2013-01-02T10:00:00.000000Z',
+            description='order', source=FakeResource(uri='/v1/cards/CC1'),
+            meta={'ignored': True},
+        ))
+        self.assertEqual(debit.amount, Decimal('19.99'))
+        self.assertEqual(debit.card_id, '/v1/cards/CC1')
+        self.assertEqual(debit.created_at.hour, 10)
+        self.assertEqual(models.Debit._sync_plan(), models.Debit._sync_plan())
+
+
+class CacheTest(TestCase):
+
+    def setUp(self):
+        self.resource_cls = mock.Mock()
+        self.resource_cls.find.side_effect = lambda uri: FakeResource(uri=uri)
+
+    def test_find_is_deduplicated_within_a_scope(self):
+        with mock.patch.dict(settings.BALANCED, CACHE_TTL=0):
+            with cache.resource_scope():
+                first = cache.find(self.resource_cls, '/v1/credits/CR1')
+                second = cache.find(self.resource_cls, '/v1/credits/CR1')
+            cache.find(self.resource_cls, '/v1/credits/CR1')
+        self.assertTrue(first is second)
+        self.assertEqual(self.resource_cls.find.call_count, 2)
+
+    def test_store_and_invalidate(self):
+        with mock.patch.dict(settings.BALANCED, CACHE_TTL=60):
+            cache.store(FakeResource(uri='/v1/credits/CR2', status='paid'))
+            found = cache.find(self.resource_cls, '/v1/credits/CR2')
+            self.assertEqual(found.status, 'paid')
+            cache.invalidate('/v1/credits/CR2')
+            cache.find(self.resource_cls, '/v1/credits/CR2')
+        self.resource_cls.find.assert_called_once_with('/v1/credits/CR2')
+
+    def test_fresh_finds_skip_cached_copies(self):
+        with mock.patch.dict(settings.BALANCED, CACHE_TTL=60):
+            cache.store(FakeResource(uri='/v1/credits/CR3', status='paid'))
+            with cache.resource_scope():
+                found = cache.find(self.resource_cls, '/v1/credits/CR3',
+                                   fresh=True)
+                self.assertTrue(
+                    cache.find(self.resource_cls, '/v1/credits/CR3') is found)
+        self.assertFalse(hasattr(found, 'status'))
+        self.resource_cls.find.assert_called_once_with('/v1/credits/CR3')
+
+
+class EscrowTest(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(marketplace, 'get_marketplace_uri',
+                                    return_value='/v1/marketplaces/MP1')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch('balanced.Marketplace.find')
+    @mock.patch.object(escrow, 'get_marketplace_uri',
+                       return_value='/v1/marketplaces/MP1')
+    def test_escrow_is_read_once_into_the_ledger(self, uri, find):
+        find.return_value = FakeResource(in_escrow=10000)
+        self.assertEqual(escrow.available(), 10000)
+        escrow.settle(escrow.reserve(2500), 2500)
+        self.assertEqual(escrow.available(), 7500)
+        self.assertEqual(find.call_count, 1)
+
+
+class LedgerTest(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(escrow, 'get_marketplace_uri',
+                                    return_value='/v1/marketplaces/MP1')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(escrow, 'refresh_escrow',
+                                    return_value=10000)
+        self.refresh_escrow = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reservations_never_overdraw(self):
+        first = escrow.reserve(6000)
+        self.assertRaises(escrow.InsufficientFunds, escrow.reserve, 6000)
+        # the balance was only read again when a reservation did not fit
+        self.assertEqual(self.refresh_escrow.call_count, 2)
+        escrow.settle(first, spent=5000)
+        self.assertEqual(escrow.available(), 5000)
+        escrow.reserve(5000)
+        self.assertEqual(escrow.available(), 0)
+
+    def test_failed_block_releases_its_reservation(self):
+        try:
+            with escrow.reserved(4000):
+                raise balanced.exc.HTTPError('boom')
+        except balanced.exc.HTTPError:
+            pass
+        self.assertEqual(escrow.available(), 10000)
+        self.assertEqual(models.EscrowReservation.objects.get().status,
+                         models.EscrowReservation.SETTLED)
+
+    def test_refresh_keeps_payouts_settled_while_reading(self):
+        reservation = escrow.reserve(6000)
+
+        def read_balance():
+            # the credit has not reached the escrow balance yet
+            escrow.settle(reservation, spent=5000)
+            return 10000
+
+        self.refresh_escrow.side_effect = read_balance
+        self.assertEqual(escrow.refresh().balance, 5000)
+        self.assertEqual(escrow.available(), 5000)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    clients = set()
+
+    def do_GET(self):
+        self.clients.add(self.client_address)
+        body = json.dumps({'id': 'CR1', 'uri': self.path}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TransportTest(TestCase):
+
+    def setUp(self):
+        StandInHandler.clients.clear()
+        # a server thread per connection, the pooled ones are kept alive
+        # and would otherwise keep shutdown() waiting
+        server = _ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        root_uri = balanced.config.root_uri
+        balanced.config.root_uri = 'http://127.0.0.1:%d' % server.server_port
+        self.addCleanup(setattr, balanced.config, 'root_uri', root_uri)
+        transport.install()
+
+    def test_requests_reuse_one_pooled_connection(self):
+        for _ in range(3):
+            credit = balanced.Credit.find('/v1/credits/CR1')
+        self.assertEqual(credit.id, 'CR1')
+        self.assertEqual(len(StandInHandler.clients), 1)
+
+    def test_round_trips_are_counted_and_labelled(self):
+        recorded = []
+
+        def receiver(sender, name, kind, value, **kwargs):
+            recorded.append((name, kind))
+
+        metrics.metric_recorded.connect(receiver)
+        self.addCleanup(metrics.metric_recorded.disconnect, receiver)
+        metrics.reset_round_trips()
+        with metrics.operation('find'):
+            balanced.Credit.find('/v1/credits/CR1')
+        balanced.Credit.find('/v1/credits/CR1')
+        self.assertEqual(metrics.round_trips(), 2)
+        self.assertTrue(('remote.find', 'timing') in recorded)
+        self.assertTrue(('remote.get', 'count') in recorded)
+
+    def test_requests_from_other_threads_share_the_session(self):
+        sessions = []
+        thread = threading.Thread(target=lambda: sessions.append(
+            balanced.Resource.http_client.interface))
+        thread.start()
+        thread.join()
+        self.assertTrue(sessions[0] is transport.get_session())
+        self.assertEqual(transport.get_session().timeout, (5, 30))
+
+    @mock.patch.dict(settings.BALANCED,
+                     MARKETPLACES={'acme': {'API_KEY': 'ak-acme'}})
+    def test_tenants_keep_their_own_session_and_cache_keys(self):
+        seen = []
+        with tenants.activate('acme') as acme:
+            session = transport.get_session()
+            key = cache._key('/v1/credits/CR1')
+            thread = threading.Thread(
+                target=lambda: seen.append(tenants.current()))
+            thread.start()
+            thread.join()
+        self.assertEqual(acme.api_key, 'ak-acme')
+        self.assertFalse(session is transport.get_session())
+        self.assertEqual(key, 'acme:django_balanced:/v1/credits/CR1')
+        self.assertEqual(seen, [tenants.get()])
+        self.assertRaises(tenants.UnknownTenant, tenants.get, 'nope')
+
+
+class PayoutTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('joe', 'joe@test.com', 'pass')
+        models.BankAccount.objects.bulk_create([
+            models.BankAccount(uri='/v1/bank_accounts/BA%d' % i,
+                               id='BA%d' % i, user=self.user,
+                               created_at=datetime(2013, 1, 1))
+            for i in range(3)
+        ])
+
+    @mock.patch.object(models.BankAccount, 'credit')
+    def test_batch_pays_each_item_once(self, credit):
+        credit.side_effect = [None, balanced.exc.HTTPError('declined'), None]
+        batch = payouts.create_batch([
+            (bank_account, 500, 'payout')
+            for bank_account in models.BankAccount.objects.order_by('uri')
+        ])
+        payouts.run_batch(batch, workers=1)
+        payouts.run_batch(batch, workers=1)
+
+        self.assertEqual(credit.call_count, 3)
+        keys = set(c[1]['meta']['idempotency_key']
+                   for c in credit.call_args_list)
+        self.assertEqual(len(keys), 3)
+        self.assertEqual(batch.progress()['paid'], 2)
+        self.assertEqual(batch.progress()['failed'], 1)
+        self.assertEqual(models.PayoutBatch.objects.get().status, 'done')
+
+    @mock.patch.object(escrow, 'refresh_escrow', return_value=2000)
+    @mock.patch.object(escrow, 'get_marketplace_uri',
+                       return_value='/v1/marketplaces/MP1')
+    @mock.patch.object(models.BankAccount, 'credit')
+    def test_batch_settles_its_escrow_reservation(self, credit, *mocks):
+        credit.side_effect = [None, balanced.exc.HTTPError('declined'), None]
+        batch = payouts.create_batch([
+            (bank_account, 500, 'payout')
+            for bank_account in models.BankAccount.objects.order_by('uri')
+        ], reservation=escrow.reserve(1500))
+        payouts.run_batch(batch, workers=1)
+        # only what was paid leaves the escrow
+        self.assertEqual(escrow.available(), 1000)
+
+    @mock.patch.object(escrow, 'refresh_escrow', return_value=2000)
+    @mock.patch.object(escrow, 'get_marketplace_uri',
+                       return_value='/v1/marketplaces/MP1')
+    @mock.patch.object(models.BankAccount, 'credit')
+    def test_crashed_batch_still_settles(self, credit, *mocks):
+        credit.side_effect = [None, KeyError('status')]
+        batch = payouts.create_batch([
+            (bank_account, 500, 'payout')
+            for bank_account in models.BankAccount.objects.order_by('uri')
+        ], reservation=escrow.reserve(1500))
+        self.assertRaises(KeyError, payouts.run_batch, batch, workers=1)
+        self.assertEqual(models.PayoutBatch.objects.get().status, 'failed')
+        self.assertEqual(escrow.available(), 1500)
+
+
+class FakeRemote(FakeResource):
+    RESOURCE = {'collection': 'resources', 'resides_under_marketplace': True}
+    posted = []
+    ids = count(1)
+
+    def save(self):
+        self.posted.append(self.__dict__.copy())
+        resource_id = 'RS%d' % next(self.ids)
+        self.__dict__.update(
+            id=resource_id,
+            uri='%s/%s' % (self.__dict__.get('uri', '/v1/resources'),
+                           resource_id),
+            created_at=datetime(2013, 1, 2),
+        )
+        return self
+
+
+class FastPathTest(TestCase):
+
+    def setUp(self):
+        FakeRemote.posted = []
+        self.user = User.objects.create_user('ann', 'ann@test.com', 'pass')
+        models.Account.objects.bulk_create([
+            models.Account(uri='/v1/marketplaces/MP1/accounts/AC1', id='AC1',
+                           user=self.user, created_at=datetime(2013, 1, 1)),
+        ])
+        models.Card.objects.bulk_create([
+            models.Card(uri='/v1/cards/CC1', id='CC1', user=self.user,
+                        created_at=datetime(2013, 1, 1), expiration_month=1,
+                        expiration_year=2020),
+        ])
+        models.BankAccount.objects.bulk_create([
+            models.BankAccount(uri='/v1/bank_accounts/BA1', id='BA1',
+                               user=self.user,
+                               created_at=datetime(2013, 1, 1)),
+        ])
+
+    @mock.patch.object(models.Debit, '_resource', FakeRemote)
+    @mock.patch.object(models.Debit, 'find')
+    def test_debit_posts_once_to_the_account_debits(self, find):
+        user = User.objects.get(pk=self.user.pk)
+        models.Account.for_user(user).debit(1999, 'order')
+        self.assertEqual(len(FakeRemote.posted), 1)
+        self.assertEqual(FakeRemote.posted[0]['uri'],
+                         '/v1/marketplaces/MP1/accounts/AC1/debits')
+        self.assertFalse(find.called)
+        debit = self.user.debits.get()
+        self.assertEqual(debit.amount, Decimal('19.99'))
+        self.assertEqual(debit.card_id, '/v1/cards/CC1')
+
+    @mock.patch.object(models.Credit, '_resource', FakeRemote)
+    @mock.patch.object(models.Credit, 'find')
+    def test_credit_posts_once_to_the_bank_account_credits(self, find):
+        bank_account = models.BankAccount.objects.get()
+        credit = bank_account.credit(500, 'payout', meta={'key': 'value'})
+        self.assertEqual(len(FakeRemote.posted), 1)
+        self.assertEqual(FakeRemote.posted[0]['uri'],
+                         '/v1/bank_accounts/BA1/credits')
+        self.assertEqual(FakeRemote.posted[0]['meta'], {'key': 'value'})
+        self.assertFalse(find.called)
+        self.assertEqual(credit.amount, Decimal('5.00'))
+
+
+@mock.patch.dict(settings.BALANCED, CALLBACK_SECRET='s3cret')
+class EventTest(TestCase):
+    urls = 'django_balanced.urls'
+
+    def setUp(self):
+        self.user = User.objects.create_user('eve', 'eve@test.com', 'pass')
+        models.BankAccount.objects.bulk_create([
+            models.BankAccount(uri='/v1/bank_accounts/BA1', id='BA1',
+                               user=self.user,
+                               created_at=datetime(2013, 1, 1)),
+        ])
+
+    def _post(self, event_id, status, secret='s3cret',
+              occurred_at='2013-01-03T00:00:00Z', bank_account='BA1'):
+        payload = {
+            'id': event_id,
+            'type': 'credit.updated',
+            'occurred_at': occurred_at,
+            'entity': {
+                'id': 'CR1',
+                'uri': '/v1/credits/CR1',
+                'created_at': '2013-01-02T00:00:00Z',
+                'amount': 500,
+                'status': status,
+                'bank_account_uri': '/v1/bank_accounts/%s' % bank_account,
+            },
+        }
+        return self.client.post('/callbacks/?secret=%s' % secret,
+                                json.dumps(payload),
+                                content_type='application/json')
+
+    def test_callback_requires_the_secret(self):
+        self.assertEqual(self._post('EV1', 'pending', 'nope').status_code,
+                         403)
+        self.assertFalse(models.BalancedEvent.objects.exists())
+
+    def test_events_are_deduplicated_and_drained_in_batches(self):
+        self.assertEqual(self._post('EV1', 'pending').status_code, 202)
+        self.assertEqual(self._post('EV1', 'pending').status_code, 202)
+        self.assertEqual(self._post('EV2', 'paid').status_code, 202)
+        self.assertEqual(events.drain_events(), 2)
+        self.assertEqual(events.drain_events(), 0)
+        credit = models.Credit.objects.get()
+        self.assertEqual(credit.status, 'paid')
+        self.assertEqual(credit.user, self.user)
+
+    @mock.patch.dict(settings.BALANCED,
+                     MARKETPLACES={'acme': {'API_KEY': 'ak-acme'}})
+    def test_events_are_applied_as_the_marketplace_they_came_for(self):
+        with tenants.activate('acme'):
+            self.assertEqual(self._post('EV1', 'paid').status_code, 202)
+        self.assertEqual(models.BalancedEvent.objects.get().marketplace,
+                         'acme')
+        self.assertEqual(events.drain_events(), 1)
+        self.assertEqual(models.Credit.objects.get().marketplace, 'acme')
+
+    def test_events_that_cannot_be_applied_yet_are_kept(self):
+        self._post('EV1', 'paid', bank_account='BA2')
+        self.assertEqual(events.drain_events(), 0)
+        event = models.BalancedEvent.objects.get()
+        self.assertIsNone(event.processed_at)
+        self.assertEqual(event.attempts, 1)
+        self.assertFalse(models.Credit.objects.exists())
+        models.BankAccount.objects.bulk_create([
+            models.BankAccount(uri='/v1/bank_accounts/BA2', id='BA2',
+                               user=self.user,
+                               created_at=datetime(2013, 1, 1)),
+        ])
+        self.assertEqual(events.drain_events(), 1)
+        self.assertEqual(models.Credit.objects.get().status, 'paid')
+
+    def test_late_events_do_not_overwrite_newer_state(self):
+        self._post('EV2', 'paid', occurred_at='2013-01-04T00:00:00Z')
+        self.assertEqual(events.drain_events(), 1)
+        self._post('EV1', 'pending', occurred_at='2013-01-03T00:00:00Z')
+        self.assertEqual(events.drain_events(), 1)
+        self.assertEqual(models.Credit.objects.get().status, 'paid')
+        self.assertFalse(models.BalancedEvent.objects.filter(
+            processed_at__isnull=True).exists())
+
+    def test_events_of_unknown_marketplaces_do_not_block_the_queue(self):
+        self._post('EV1', 'paid')
+        models.BalancedEvent.objects.create(
+            id='EV0', type='credit.updated', entity_uri='/v1/credits/CR0',
+            marketplace='gone', payload=json.dumps({
+                'id': 'EV0', 'entity': {'uri': '/v1/credits/CR0'}}))
+        self.assertEqual(events.drain_events(), 1)
+        self.assertEqual(models.Credit.objects.get().status, 'paid')
+        event = models.BalancedEvent.objects.get(id='EV0')
+        self.assertIsNone(event.processed_at)
+        self.assertEqual(event.attempts, 1)
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'asyncio api needs python 3.5')
+class AsyncTest(TestCase):
+
+    def test_gather_bounded_limits_concurrency(self):
+        from django_balanced import aio
+
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def pay(amount):
+            with lock:
+                running.append(amount)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(amount)
+            return amount
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        paid = loop.run_until_complete(aio.gather_bounded(
+            *[aio.run(pay, amount) for amount in range(10)], limit=3))
+        self.assertEqual(paid, list(range(10)))
+        self.assertTrue(max(peak) <= 3)
+
+    @mock.patch.dict(settings.BALANCED,
+                     MARKETPLACES={'acme': {'API_KEY': 'ak-acme'}})
+    def test_calls_run_as_the_tenant_awaiting_them(self):
+        from django_balanced import aio
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        with tenants.activate('acme'):
+            tenant = loop.run_until_complete(aio.run(tenants.current))
+        self.assertEqual(tenant.name, 'acme')
+
+
+@mock.patch.object(models.Account, '_resource', FakeRemote)
+@mock.patch.object(marketplace, 'get_marketplace_uri',
+                   mock.Mock(return_value='/v1/marketplaces/MP1'))
+class ProvisioningTest(TestCase):
+
+    def setUp(self):
+        FakeRemote.posted = []
+
+    def test_saving_users_does_not_create_accounts(self):
+        user = User.objects.create_user('sam', 'sam@test.com', 'pass')
+        user.save()
+        self.assertFalse(models.Account.objects.exists())
+        account = models.Account.for_user(user)
+        self.assertEqual(account.user, user)
+        self.assertEqual(FakeRemote.posted, [
+            {'uri': '/v1/marketplaces/MP1/resources', 'name': 'sam'}])
+        self.assertEqual(models.Account.for_user(user), account)
+        self.assertEqual(len(FakeRemote.posted), 1)
+
+    def test_concurrent_calls_create_one_remote_account(self):
+        user = User.objects.create_user('sue', 'sue@test.com', 'pass')
+        users = User.objects.all()
+
+        def lock():
+            # another thread created the account while this one waited
+            models.Account.objects.bulk_create([
+                models.Account(uri='/v1/accounts/AC1', id='AC1', user=user,
+                               created_at=datetime(2013, 1, 1)),
+            ])
+            return users
+
+        with mock.patch.object(User.objects, 'select_for_update',
+                               side_effect=lock):
+            account = models.Account.for_user(user)
+        self.assertEqual(account.uri, '/v1/accounts/AC1')
+        self.assertEqual(FakeRemote.posted, [])
+
+    @mock.patch.dict(settings.BALANCED,
+                     MARKETPLACES={'acme': {'API_KEY': 'ak-acme'}})
+    def test_users_get_an_account_per_marketplace(self):
+        user = User.objects.create_user('ann', 'ann@test.com', 'pass')
+        account = models.Account.for_user(user)
+        with tenants.activate('acme'):
+            # the account of the user in acme links up although they
+            # have one in the default marketplace already
+            models.Account._sync_chunk([FakeResource(
+                id='AC9', uri='/v1/marketplaces/MP2/accounts/AC9',
+                created_at=datetime(2013, 1, 1), name='ann')])
+            other = models.Account.for_user(user)
+        self.assertEqual(other.id, 'AC9')
+        self.assertEqual(other.marketplace, 'acme')
+        self.assertNotEqual(other, account)
+        self.assertEqual(models.Account.for_user(user), account)
+        self.assertEqual(len(FakeRemote.posted), 1)
+
+    def test_backfill_provisions_users_without_accounts(self):
+        for name in ('tom', 'tim'):
+            User.objects.create_user(name, '%s@test.com' % name, 'pass')
+        self.assertEqual(provisioning.backfill(), 2)
+        self.assertEqual(provisioning.backfill(), 0)
+        self.assertEqual(models.Account.objects.count(), 2)
+
+    @mock.patch.object(provisioning.transaction, 'on_commit', None,
+                       create=True)
+    def test_without_commit_hook_accounts_wait_for_the_request(self):
+        # the test runs inside a transaction
+        with mock.patch.object(provisioning, '_enqueue') as enqueue:
+            provisioning.provision_later(1)
+            self.assertFalse(enqueue.called)
+            request_finished.send(sender=self.__class__)
+            enqueue.assert_called_once_with(1, tenants.current())
+            request_finished.send(sender=self.__class__)
+            self.assertEqual(enqueue.call_count, 1)
+
+
+class ThrottleTest(TestCase):
+
+    def test_interactive_calls_go_before_background_ones(self):
+        bucket = throttle.TokenBucket(rate=50, burst=1)
+        bucket.acquire()
+        order = []
+
+        def call(lane):
+            bucket.acquire(lane)
+            order.append(lane)
+
+        background = threading.Thread(target=call,
+                                      args=(throttle.BACKGROUND,))
+        background.start()
+        time.sleep(0.005)
+        interactive = threading.Thread(target=call,
+                                       args=(throttle.INTERACTIVE,))
+        interactive.start()
+        background.join()
+        interactive.join()
+        self.assertEqual(order, [throttle.INTERACTIVE, throttle.BACKGROUND])
+
+    def test_only_rejected_or_idempotent_calls_are_retried(self):
+        def response(status, **headers):
+            return FakeResource(status_code=status, headers=headers)
+
+        with mock.patch.dict(settings.BALANCED, RETRY_ATTEMPTS=3,
+                             RETRY_BACKOFF=1, RETRY_BACKOFF_MAX=30):
+            self.assertEqual(throttle.retry_delay(
+                response(429, **{'Retry-After': '7'}), 'post', 0), 7)
+            self.assertEqual(throttle.retry_delay(
+                response(429, **{'Retry-After': '3600'}), 'post', 0), 30)
+            self.assertTrue(
+                0 <= throttle.retry_delay(response(503), 'get', 2) <= 4)
+            self.assertEqual(
+                throttle.retry_delay(response(503), 'post', 0), None)
+            self.assertEqual(
+                throttle.retry_delay(response(429), 'post', 3), None)
+            self.assertEqual(
+                throttle.retry_delay(response(402), 'post', 0), None)
+
+
+class MetricsTest(TestCase):
+
+    def test_in_memory_backend_collects_timings_and_counts(self):
+        backend = metrics.InMemoryMetrics()
+        with mock.patch.object(metrics, 'get_backend', return_value=backend):
+            with metrics.timed('sync.write'):
+                pass
+            metrics.incr('sync.write', 2)
+        self.assertEqual(backend.counts['sync.write'], 3)
+        self.assertTrue(backend.timings['sync.write'] >= 0)
+
+    @mock.patch.object(metrics.StatsdMetrics, '_send')
+    def test_statsd_line_format(self, send):
+        backend = metrics.StatsdMetrics(prefix='pay')
+        backend.timing('remote.find', 12.7)
+        backend.incr('remote.find')
+        self.assertEqual([c[0][0] for c in send.call_args_list],
+                         ['pay.remote.find:12|ms', 'pay.remote.find:1|c'])
+
+
+class FakeBalancedTest(TestCase):
+
+    def test_sync_pages_through_the_fake(self):
+        User.objects.bulk_create([User(username='user%d' % i)
+                                  for i in range(25)])
+        with FakeBalanced() as fake:
+            fake.seed('accounts', 25, lambda i: {'name': 'user%d' % i})
+            stats = models.Account.sync(chunk_size=10)
+        self.assertEqual(stats['inserted'], 25)
+        self.assertEqual(models.Account.objects.filter(
+            user__username='user7').get().uri, '/v1/accounts/ACfake7')
+
+    def test_concurrent_sync_writes_every_range_once(self):
+        User.objects.bulk_create([User(username='user%d' % i)
+                                  for i in range(60)])
+
+        class SerialPool(object):
+            # the in-memory test database is private to each thread
+            def __init__(self, workers):
+                pass
+
+            def imap(self, func, iterable):
+                return [func(args) for args in iterable]
+
+            def close(self):
+                pass
+
+            join = close
+
+        with FakeBalanced() as fake:
+            fake.seed('accounts', 60, lambda i: {'name': 'user%d' % i})
+            with mock.patch.object(sync, 'ThreadPool', SerialPool):
+                results = sync.sync_all([models.Account], workers=4,
+                                        chunk_size=10)
+        self.assertEqual(results[0][1]['inserted'], 60)
+        self.assertEqual(models.Account.objects.count(), 60)
+
+    def test_injected_failures_are_retried(self):
+        with mock.patch.dict(settings.BALANCED, RETRY_ATTEMPTS=50):
+            with FakeBalanced(error_rate=0.5, error_status=429,
+                              seed=1) as fake:
+                fake.seed('credits', 1)
+                credit = balanced.Credit.find(fake.uri('credits', 0))
+        self.assertEqual(credit.id, 'CRfake0')
+        self.assertTrue(fake.round_trips > 1)
+
+    def test_benchmarks_report_every_scenario(self):
+        results = benchmarks.run_benchmarks(
+            sizes=[30], recipients=[3], payout_workers=1, chunk_size=10)
+        json.dumps(results)
+        self.assertEqual(results['sync'][0]['stats']['inserted'], 30)
+        self.assertEqual(results['payouts'][0]['paid'], 3)
+        self.assertEqual(results['round_trips']['find_cached'], 0)
+        self.assertEqual(results['round_trips']['credit'], 1)
+
+
+class RefreshTest(TestCase):
+
+    def test_changed_rows_are_written_back(self):
+        user = User.objects.create_user('joe', 'joe@test.com', 'pass')
+        created_at = EPOCH
+        if settings.USE_TZ:
+            created_at = timezone.make_aware(EPOCH, timezone.utc)
+        bank_account = models.BankAccount(uri='/v1/bank_accounts/BAfake0',
+                                          id='BAfake0', user=user,
+                                          created_at=created_at)
+        models.BankAccount.objects.bulk_create([bank_account])
+        models.Credit.objects.bulk_create([
+            models.Credit(uri='/v1/credits/CRfake%d' % i, id='CRfake%d' % i,
+                          created_at=created_at + timedelta(seconds=i),
+                          bank_account=bank_account, user=user,
+                          amount=Decimal('1.00'), status='pending')
+            for i in range(4)
+        ])
+        with FakeBalanced() as fake:
+            fake.seed('credits', 3, lambda i: {
+                'amount': 100, 'bank_account_uri': bank_account.uri})
+            # deleted on balanced since it was stored, found as a 404
+            fake.collection('credits').deleted.add(1)
+            stats = user.credits.refresh_from_balanced(workers=2)
+        self.assertEqual(stats['updated'], 2)
+        self.assertEqual(stats['missing'], 2)
+        self.assertEqual(
+            sorted(models.Credit.objects.values_list('status', flat=True)),
+            ['paid', 'paid', 'pending', 'pending'])
+        self.assertEqual(
+            models.Credit.objects.get(id='CRfake1').status, 'pending')
+
+
+class AdminTest(TestCase):
+    urls = 'django_balanced.tests'
+
+    def setUp(self):
+        user = User.objects.create_user('joe', 'joe@test.com', 'pass')
+        models.BankAccount.objects.bulk_create([
+            models.BankAccount(uri='/v1/bank_accounts/BA%d' % i,
+                               id='BA%d' % i, user=user,
+                               created_at=datetime(2013, 1, 1, 0, 0, i))
+            for i in range(5)
+        ])
+
+    @mock.patch.object(balanced_admin.BankAccountAdmin, 'list_per_page', 2)
+    def test_changelist_pages_by_cursor_with_actions(self):
+        User.objects.create_superuser('root', 'root@test.com', 'pass')
+        self.client.login(username='root', password='pass')
+        url = '/admin/django_balanced/bankaccount/'
+        query = ''
+        pages = []
+        while query is not None:
+            response = self.client.get(url + query)
+            self.assertEqual(response.status_code, 200)
+            changelist = response.context['cl']
+            self.assertTrue(changelist.keyset)
+            self.assertTrue(changelist.show_admin_actions)
+            self.assertContains(response, 'name="action"')
+            pages.append([row.id for row in changelist.result_list])
+            query = changelist.next_cursor and changelist.next_page_url()
+        self.assertEqual(pages, [['BA4', 'BA3'], ['BA2', 'BA1'], ['BA0']])
+
+    def test_paginator_stops_counting_at_the_cap(self):
+        paginator = balanced_admin.EstimatedCountPaginator(
+            models.BankAccount.objects.filter(user__username='joe'), 2)
+        paginator.cap = 3
+        self.assertEqual(paginator.count, 4)
+        self.assertEqual(balanced_admin.EstimatedCountPaginator(
+            models.BankAccount.objects.all(), 2).count, 5)
+
+    @mock.patch.object(balanced_admin.messages, 'error')
+    @mock.patch.object(balanced_admin, 'render')
+    @mock.patch.object(escrow, 'reserve',
+                       side_effect=escrow.InsufficientFunds('no funds'))
+    def test_bulk_pay_without_funds_asks_again(self, reserve, render, error):
+        request = RequestFactory().post('/', {
+            'bank_account_0': '/v1/bank_accounts/BA1',
+            'bank_account_0_amount': '5',
+            'bank_account_0_description': 'payout',
+        })
+        request.user = User.objects.get()
+        bank_account_admin = balanced_admin.BankAccountAdmin(
+            models.BankAccount, balanced_admin.admin.site)
+        response = bank_account_admin.bulk_pay_view(request)
+        self.assertEqual(response, render.return_value)
+        error.assert_called_once_with(request, 'no funds')
+        self.assertEqual(
+            list(render.call_args[0][2]['bank_accounts']),
+            [(0, models.BankAccount.objects.get(id='BA1'))])
+        self.assertFalse(models.PayoutBatch.objects.exists())
+
+    @mock.patch.object(balanced_admin.messages, 'error')
+    @mock.patch.object(balanced_admin.BalancedAdmin, 'add_view',
+                       side_effect=escrow.InsufficientFunds('no funds'))
+    def test_credit_without_funds_returns_to_the_form(self, add_view, error):
+        request = RequestFactory().post('/admin/credits/add/')
+        credit_admin = balanced_admin.CreditAdmin(
+            models.Credit, balanced_admin.admin.site)
+        response = credit_admin.add_view(request)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].endswith('/admin/credits/add/'))
+        error.assert_called_once_with(request, 'no funds')
+
+    def test_user_filter_takes_a_username_or_id(self):
+        user_filter = balanced_admin.UserLookupFilter(
+            None, {'user': 'joe'}, models.BankAccount, None)
+        queryset = models.BankAccount.objects.all()
+        self.assertEqual(user_filter.queryset(None, queryset).count(), 5)
+        user_filter = balanced_admin.UserLookupFilter(
+            None, {'user': '999'}, models.BankAccount, None)
+        self.assertEqual(user_filter.queryset(None, queryset).count(), 0)
+
+
+class ReconcileTest(TestCase):
+
+    def test_only_differing_buckets_are_fetched(self):
+        user = User.objects.create_user('joe', 'joe@test.com', 'pass')
+        bank_account = models.BankAccount(uri='/v1/bank_accounts/BAfake0',
+                                          id='BAfake0', user=user,
+                                          created_at=datetime(2013, 1, 1))
+        models.BankAccount.objects.bulk_create([bank_account])
+        since = EPOCH
+        if settings.USE_TZ:
+            since = timezone.make_aware(EPOCH, timezone.utc)
+        with FakeBalanced() as fake:
+            fake.seed('credits', 40, lambda i: {
+                'amount': 100, 'bank_account_uri': bank_account.uri})
+            models.Credit.sync()
+            models.Credit.objects.filter(uri=fake.uri('credits', 3)).delete()
+            models.Credit.objects.filter(
+                uri=fake.uri('credits', 25)).update(status='pending')
+            models.Credit.objects.bulk_create([models.Credit(
+                uri='/v1/credits/CRlocal', id='CRlocal', user=user,
+                bank_account=bank_account, amount=1, status='paid',
+                created_at=since + timedelta(seconds=28))])
+            result = reconcile.Reconciliation(
+                models.Credit, since, since + timedelta(seconds=40),
+                bucket=timedelta(seconds=10), fix=True).run()
+        self.assertEqual(result.fetched, 2)
+        self.assertEqual(result.missing, [fake.uri('credits', 3)])
+        self.assertEqual(result.extra, ['/v1/credits/CRlocal'])
+        self.assertEqual(result.diverged, [
+            (fake.uri('credits', 25), 'status', 'pending', 'paid')])
+        self.assertEqual(models.Credit.objects.get(
+            uri=fake.uri('credits', 25)).status, 'paid')
+
+
+class ExportTest(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user('joe', 'joe@test.com', 'pass')
+        self.since = EPOCH
+        if settings.USE_TZ:
+            self.since = timezone.make_aware(EPOCH, timezone.utc)
+        bank_account = models.BankAccount(uri='/v1/bank_accounts/BA1',
+                                          id='BA1', user=user,
+                                          created_at=self.since)
+        models.BankAccount.objects.bulk_create([bank_account])
+        models.Credit.objects.bulk_create([
+            models.Credit(uri='/v1/credits/CR%d' % i, id='CR%d' % i,
+                          created_at=self.since + timedelta(days=i),
+                          bank_account=bank_account, user=user,
+                          amount=Decimal('1.50'),
+                          status='paid' if i % 2 else 'pending')
+            for i in range(5)
+        ])
+
+    def test_rows_are_streamed_in_pages(self):
+        lines = list(export.export(models.Credit.objects.all(), 'csv',
+                                   chunk_size=2))
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(lines[0].rstrip('\r\n').split(','), [
+            f.attname for f in export.export_fields(models.Credit)])
+        self.assertIn('/v1/credits/CR4', lines[-1])
+
+    def test_rows_are_filtered_by_date_and_status(self):
+        rows = export.filter_rows(models.Credit.objects.all(),
+                                  since=self.since + timedelta(days=1),
+                                  statuses=['paid'])
+        records = [json.loads(line) for line in export.export(rows, 'jsonl')]
+        self.assertEqual([r['id'] for r in records], ['CR1', 'CR3'])
+        # decimals are written as strings, sqlite drops trailing zeros
+        self.assertEqual(Decimal(records[0]['amount']), Decimal('1.50'))
+        self.assertRaises(ValueError, export.filter_rows,
+                          models.BankAccount.objects.all(), statuses=['paid'])
+
+    @mock.patch.dict(settings.BALANCED,
+                     MARKETPLACES={'acme': {'API_KEY': 'ak-acme'}})
+    def test_command_exports_one_marketplace(self):
+        models.Credit.objects.filter(id='CR4').update(marketplace='acme')
+
+        def exported(**options):
+            out = StringIO()
+            call_command('balanced_export', 'credit', format='jsonl',
+                         stdout=out, **options)
+            return [json.loads(line)['id']
+                    for line in out.getvalue().splitlines()]
+
+        self.assertEqual(exported(), ['CR0', 'CR1', 'CR2', 'CR3'])
+        self.assertEqual(exported(marketplace='acme', since='2013-01-02'),
+                         ['CR4'])
+        self.assertRaises(CommandError, exported, marketplace='gone')
@@ -0,0 +1,144 @@
+from __future__ import unicode_literals
+from contextlib import contextmanager
+import random
+import threading
+import time
+
+from django.conf import settings
+
+from django_balanced import tenants
+from django_balanced.cache import get_backend
+
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+_local = threading.local()
+
+
+def current_lane():
+    return getattr(_local, 'lane', INTERACTIVE)
+
+
+@contextmanager
+def lane(name):
+    """
+    Tags the calls made by this thread, e.g. `lane(BACKGROUND)` for syncs
+    and batch jobs so payments made while serving users go first.
+    """
+    outer = current_lane()
+    _local.lane = name
+    try:
+        yield
+    finally:
+        _local.lane = outer
+
+
+class TokenBucket(object):
+    """
+    Admits `rate` calls a second on average and up to `burst` at once.
+    Background callers only get a token while no interactive caller waits.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.interactive_waiting = 0
+        self.condition = threading.Condition()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, lane=INTERACTIVE):
+        with self.condition:
+            interactive = lane == INTERACTIVE
+            if interactive:
+                self.interactive_waiting += 1
+            try:
+                while True:
+                    self._refill()
+                    if self.tokens >= 1 and (
+                            interactive or not self.interactive_waiting):
+                        self.tokens -= 1
+                        return
+                    self.condition.wait(max(1 - self.tokens, 0.1) / self.rate)
+            finally:
+                if interactive:
+                    self.interactive_waiting -= 1
+                self.condition.notify_all()
+
+
+def _get_bucket():
+    # every tenant is limited separately, as balanced limits each api key
+    tenant = tenants.current()
+    if tenant.bucket is None:
+        with tenant.lock:
+            if tenant.bucket is None:
+                tenant.bucket = TokenBucket(
+                    settings.BALANCED['RATE_LIMIT'],
+                    settings.BALANCED['RATE_LIMIT_BURST'])
+    return tenant.bucket
+
+
+def reset():
+    """
+    Drops the token buckets, e.g. after changing the rate limit settings.
+    """
+    for tenant in list(tenants._tenants.values()):
+        tenant.bucket = None
+
+
+def _acquire_shared(rate):
+    # fixed one second windows counted in the django cache, shared by every
+    # process using it
+    backend = get_backend()
+    while True:
+        now = time.time()
+        key = tenants.current().qualify('django_balanced:rate:%d' % now)
+        backend.add(key, 0, 2)
+        try:
+            if backend.incr(key) <= rate:
+                return
+        except ValueError:  # the window expired in between
+            continue
+        time.sleep(1 - now % 1)
+
+
+def acquire():
+    """
+    Blocks until the rate limits admit one more call to Balanced.
+    """
+    rate = settings.BALANCED['RATE_LIMIT']
+    if not rate:
+        return
+    _get_bucket().acquire(current_lane())
+    if settings.BALANCED['RATE_LIMIT_SHARED']:
+        _acquire_shared(rate)
+
+
+def retry_delay(response, method, attempt):
+    """
+    Seconds to wait before retrying the call that got `response`, or None
+    when it must not be retried. Rate limited calls were never processed and
+    are always retried; server errors only for idempotent methods, a POST
+    may have gone through.
+    """
+    if attempt >= settings.BALANCED['RETRY_ATTEMPTS']:
+        return None
+    status = response.status_code
+    if status != 429 and not (status >= 500 and method.upper() != 'POST'):
+        return None
+    retry_after = response.headers.get('Retry-After')
+    if retry_after and retry_after.isdigit():
+        # never sleep for longer than a backoff would, however long asked
+        return min(float(retry_after),
+                   settings.BALANCED['RETRY_BACKOFF_MAX'])
+    # exponential backoff with full jitter
+    cap = min(settings.BALANCED['RETRY_BACKOFF_MAX'],
+              settings.BALANCED['RETRY_BACKOFF'] * 2 ** attempt)
+    return random.uniform(0, cap)
@@ -0,0 +1,121 @@
+from __future__ import unicode_literals
+import time
+
+import balanced
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from django_balanced import metrics, tenants, throttle
+
+try:
+    from requests.packages.urllib3.util.retry import Retry
+except ImportError:  # requests < 2.4 only knows a retry count
+    Retry = None
+
+
+class PooledSession(requests.Session):
+    """
+    A session applying the configured timeouts to every request that does
+    not set its own. Requests wait for the rate limits of
+    `django_balanced.throttle` and rate limited or failed ones are retried
+    with backoff before the response hooks, which raise the client's
+    errors, get to see them.
+    """
+
+    def __init__(self, timeout):
+        super(PooledSession, self).__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        api_key = tenants.current().api_key
+        if api_key is not None:
+            # balanced takes the secret as the basic auth user name
+            kwargs['auth'] = (api_key, '')
+        hooks = kwargs.pop('hooks', None) or {}
+        attempt = 0
+        while True:
+            throttle.acquire()
+            started = time.time()
+            response = super(PooledSession, self).request(
+                method, url, **kwargs)
+            metrics.record_round_trip(method, (time.time() - started) * 1000)
+            delay = throttle.retry_delay(response, method, attempt)
+            if delay is None:
+                break
+            response.close()
+            time.sleep(delay)
+            attempt += 1
+        response_hooks = hooks.get('response') or ()
+        if callable(response_hooks):
+            response_hooks = [response_hooks]
+        for hook in response_hooks:
+            response = hook(response) or response
+        return response
+
+
+def _make_session():
+    config = settings.BALANCED
+    retries = config['HTTP_RETRIES']
+    if Retry is not None:
+        # only idempotent requests are retried after they reached the
+        # server, a credit must never be sent twice. error responses are
+        # retried by PooledSession.request
+        retries = Retry(total=retries,
+                        backoff_factor=config['HTTP_BACKOFF'])
+    adapter = HTTPAdapter(pool_connections=config['HTTP_POOL_SIZE'],
+                          pool_maxsize=config['HTTP_POOL_SIZE'],
+                          max_retries=retries)
+    session = PooledSession(timeout=(config['HTTP_CONNECT_TIMEOUT'],
+                                     config['HTTP_READ_TIMEOUT']))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    """
+    The keep-alive session shared by every thread talking to Balanced for
+    the current tenant.
+    """
+    tenant = tenants.current()
+    if tenant.session is None:
+        with tenant.lock:
+            if tenant.session is None:
+                tenant.session = _make_session()
+    return tenant.session
+
+
+class PooledHTTPClient(balanced.HTTPClient):
+    # the stock client is thread local and opens a session per thread, this
+    # one uses the pool of the tenant active in the calling thread
+
+    @property
+    def interface(self):
+        return get_session()
+
+    @interface.setter
+    def interface(self, session):
+        pass
+
+
+def install():
+    """
+    Routes every call made by the `balanced` client through the pooled
+    session. Safe to call more than once.
+    """
+    if isinstance(balanced.Resource.http_client, PooledHTTPClient):
+        return
+    client = PooledHTTPClient()
+    balanced.http_client = client
+    balanced.Resource.http_client = client
+
+
+def configure():
+    """
+    Configures the `balanced` client with `BALANCED['API_KEY']` on top of
+    the pooled transport.
+    """
+    install()
+    balanced.configure(settings.BALANCED['API_KEY'])
@@ -4,4 +4,5 @@ from django.conf.urls import patterns, url
 urlpatterns = patterns(
     'django_balanced.views',
     url(r'^bank_accounts/$', 'bank_account'),
+    url(r'^callbacks/$', 'callback', name='balanced_callback'),
 )
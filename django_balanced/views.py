@@ -1,8 +1,39 @@
 from __future__ import unicode_literals
+import json
 
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, \
+    HttpResponseForbidden
 from django.shortcuts import render
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from django_balanced.events import record_event
 
 
 def bank_accounts(request):
     data = {}
     return render(request, 'django_balanced/bank_account_form.html', **data)
+
+
+@csrf_exempt
+@require_POST
+def callback(request):
+    """
+    Receives Balanced event callbacks. Register the callback with the
+    `BALANCED['CALLBACK_SECRET']` as its `secret` query parameter, and for
+    each marketplace at a url `BALANCED['TENANT_RESOLVER']` maps to it.
+    """
+    secret = settings.BALANCED['CALLBACK_SECRET']
+    if not secret or not constant_time_compare(
+            request.GET.get('secret', ''), secret):
+        return HttpResponseForbidden()
+    try:
+        payload = json.loads(request.body)
+        payload['id']
+    except (ValueError, TypeError, KeyError):
+        return HttpResponseBadRequest()
+    record_event(payload)
+    # events are applied in batches by the drain_events command
+    return HttpResponse(status=202)